@@ -0,0 +1,74 @@
+
+#
+# Tracking the mixer's audio clock, for starting hits sample-accurately
+#
+from adafruit_ticks import ticks_ms, ticks_diff, ticks_add
+
+class AudioClock:
+    """
+    Estimates where the mixer is in its output buffer from how long ago audio
+    output started, since the mixer consumes samples at a steady sample_rate.
+
+    A voice started now is heard at the start of the buffer after the next one,
+    so anywhere from one to two buffers later depending on where in the buffer
+    "now" is. That's up to a whole buffer of jitter between hits. pad_samples()
+    says how much silence to put in front of a hit so that it's always heard
+    exactly two buffers after its deadline, as long as it's started before its
+    deadline (see DrumSequencer.lead_millis).
+
+    There's no way to read the mixer's sample count in CircuitPython, so this is
+    only as good as 'start_millis' and the millisecond clock, to a millisecond or so.
+    Close to a buffer boundary that's not good enough to tell which buffer a hit
+    will land in, so pad_samples() waits until 'margin_millis' past the boundary.
+    """
+    def __init__(self, sample_rate, buffer_size, start_millis=None, pad_step=32, margin_millis=2):
+        self.sample_rate = sample_rate
+        self.pad_step = pad_step  # samples of silence between padded sample variants
+        self.margin_millis = margin_millis
+        # smallest whole number of millis that is a whole number of samples (20 ms = 441 @ 22050)
+        a, b = sample_rate, 1000
+        while b:
+            a, b = b, a % b
+        self.epoch_step_millis = 1000 // a
+        self.epoch_step_samples = sample_rate // a
+        self.restart(buffer_size, start_millis)
+
+    def restart(self, buffer_size, start_millis=None):
+        """Call when audio output (re)starts, e.g. after DrumCardHardware.set_latency()"""
+        self.buffer_samples = buffer_size // 2  # 16-bit mono
+        # samples either side of a buffer boundary to wait out, less than half a buffer
+        self.margin = min(self.margin_millis * self.sample_rate // 1000, self.buffer_samples // 2 - 1)
+        self.epoch_millis = ticks_ms() if start_millis is None else start_millis
+        self.epoch_pos = 0  # position in the output buffer at epoch_millis, in samples
+
+    def buffer_pos(self, now):
+        """Which sample of its current buffer the mixer is outputting at ticks_ms 'now'"""
+        elapsed = ticks_diff(now, self.epoch_millis)
+        if elapsed > 1000:  # move epoch up by whole samples, keeps the math in small ints
+            n = elapsed // self.epoch_step_millis
+            self.epoch_millis = ticks_add(self.epoch_millis, n * self.epoch_step_millis)
+            self.epoch_pos = (self.epoch_pos + n * self.epoch_step_samples) % self.buffer_samples
+            elapsed -= n * self.epoch_step_millis
+        return (self.epoch_pos + elapsed * self.sample_rate // 1000) % self.buffer_samples
+
+    def pad_samples(self, deadline):
+        """
+        Samples of silence to put in front of a hit started now so it's
+        heard two buffers after 'deadline'. Zero if started after its deadline.
+        """
+        now = ticks_ms()
+        pos = self.buffer_pos(now)
+        while pos < self.margin or pos >= self.buffer_samples - self.margin:
+            now = ticks_ms()  # too close to a buffer boundary to be sure, wait it out
+            pos = self.buffer_pos(now)
+        pad = pos + ticks_diff(deadline, now) * self.sample_rate // 1000
+        return pad if pad > 0 else 0
+
+    def max_pad_samples(self, lead_millis):
+        """Most silence pad_samples() asks for, for hits started up to 'lead_millis' early"""
+        return self.buffer_samples - self.margin + lead_millis * self.sample_rate // 1000
+
+    def variant(self, deadline, num_variants):
+        """Which of the padded variants made by drum_kits.make_padded_variants() to play"""
+        v = (self.pad_samples(deadline) + self.pad_step // 2) // self.pad_step
+        return v if v < num_variants else num_variants - 1
@@ -0,0 +1,73 @@
+
+#
+# Audio latency profiles and automatic mixer buffer sizing
+#
+from adafruit_ticks import ticks_ms, ticks_diff
+
+# audiomixer.Mixer buffer_size (in bytes, 2 bytes per 16-bit mono sample) for each profile.
+# The mixer double-buffers: a sound started now goes into the next buffer to be mixed,
+# which plays after the one going out now, so a hit can take up to two buffers to be heard.
+# Smaller buffers mean less latency, but if something holds up the CPU longer than one
+# buffer (flash writes, opening files, gc) the mixer can't keep up and the audio glitches.
+latency_profiles = {
+    'safe': 2048,    # ~46 ms buffers at 22050 Hz, up to ~93 ms latency
+    'normal': 1024,  # ~23 ms, up to ~46 ms
+    'low': 512,      # ~12 ms, up to ~23 ms
+    'lowest': 256,   # ~6 ms, up to ~12 ms
+}
+
+def buffer_millis(buffer_size, sample_rate=22050):
+    """How many millis of 16-bit mono audio a mixer buffer of buffer_size bytes holds"""
+    return buffer_size * 500 / sample_rate
+
+def latency_millis(buffer_size, sample_rate=22050):
+    """Worst case time from voice.play() to the sound coming out, for a mixer buffer size"""
+    return 2 * buffer_millis(buffer_size, sample_rate)
+
+
+class LatencyTuner:
+    """
+    Picks the smallest latency profile whose mixer buffer is longer than the
+    longest the event loop has been held up lately (times 'margin'), since
+    that's about how long the mixer may wait to be refilled.
+    Feed it stalls with note_stall(), e.g. from a task that sleeps a few millis
+    and measures how much longer than that it actually took to wake up.
+    Stalls are remembered for one to two 'window_millis'.
+    """
+    def __init__(self, sample_rate=22050, profiles=latency_profiles, margin=1.5, window_millis=10_000):
+        self.sample_rate = sample_rate
+        self.profiles = profiles
+        self.names = sorted(profiles, key=lambda n: profiles[n])  # smallest buffer first
+        self.margin = margin
+        self.window_millis = window_millis
+        self.window_start = ticks_ms()
+        self.max_stall = 0  # longest stall in this window, millis
+        self.last_max_stall = 0  # longest stall in previous window
+
+    def note_stall(self, stall_millis, now=None):
+        now = ticks_ms() if now is None else now
+        if stall_millis > self.max_stall:
+            self.max_stall = stall_millis
+        if ticks_diff(now, self.window_start) > self.window_millis:
+            self.window_start = now
+            self.last_max_stall = self.max_stall
+            self.max_stall = 0
+
+    def worst_stall(self):
+        return max(self.max_stall, self.last_max_stall)
+
+    def pick(self, current, allow_smaller=True):
+        """
+        Return the profile name to use now, given the 'current' one.
+        Changing mixer buffer size makes a click, so pass allow_smaller=False
+        while playing to only go to a bigger buffer when it's needed.
+        """
+        need = self.worst_stall() * self.margin
+        best = self.names[-1]
+        for name in self.names:
+            if buffer_millis(self.profiles[name], self.sample_rate) >= need:
+                best = name
+                break
+        if not allow_smaller and self.profiles[best] < self.profiles[current]:
+            return current
+        return best
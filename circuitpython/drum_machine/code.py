@@ -17,31 +17,99 @@ from adafruit_ticks import ticks_ms, ticks_diff, ticks_add
 
 from drumcard_hardware import DrumCardHardware
 
-from drum_kits import find_kits, load_drumkit
-from drum_sequencer import DrumSequencer
-
+from drum_kits import find_kits, load_drumkit, iter_load_drumkit, SampleCache
+from drum_sequencer import DrumSequencer, PatternSaver
+from drum_voices import VoiceAllocator
+from audio_latency import LatencyTuner, latency_profiles
+from audio_clock import AudioClock
+from note_pool import NotePool
+from touch_events import TouchEvents
+from touch_filter import TouchFilter
+from pad_velocity import PadVelocity
+
+
+# set each touch pad's sensitivity at boot from how noisy it is,
+# instead of all pads using ts20.PADSENS (keep hands off the pads while booting)
+touch_calibrate = False
+# velocity-sensitive drum pads, from how fast the pad's raw capacitance changes
+# (see pad_velocity.py), plays each hit about 5 ms later, once it's measured
+touch_velocity = False
 
 midi_base = 42
 pad_to_midi = ( 0, 2, 4, 5, 7, 9, 10, 12)
         
+# audio latency profile: 'safe', 'normal', 'low', 'lowest' (see audio_latency.py),
+# or 'auto' to use the smallest mixer buffer that other tasks don't hold up too long
+audio_latency = 'auto'
+start_latency = 'normal' if audio_latency == 'auto' else audio_latency
+
+# audio sync: start sequencer hits in step with the mixer's buffers (see audio_clock.py),
+# so each hit is heard the same time after its step, instead of anywhere within a buffer.
+# only works for samples in the sample cache, and needs a buffer of silence for each,
+# sized for the biggest buffer 'auto' can pick
+audio_sync = False
+seq_lead_millis = 3  # in audio sync mode, play steps this early, to have time to line them up
+sync_buffer = max(latency_profiles.values()) if audio_latency == 'auto' else latency_profiles[audio_latency]
+sync_pad = (sync_buffer // 2 + seq_lead_millis * 22050 // 1000) if audio_sync else 0
+
+# keep drum samples in RAM so playing them doesn't read flash,
+# kits bigger than sample_cache_bytes stream from flash instead.
+# set to 0 to always stream
+sample_cache_bytes = 48_000
+sample_cache = SampleCache(sample_cache_bytes, pad=sync_pad) if sample_cache_bytes else None
+
+start_millis = ticks_ms()
 kits = find_kits()
+print("find_kits: %d ms" % ticks_diff(ticks_ms(), start_millis))
 kit_index = 0
-waves, num_trigs = load_drumkit(kits, kit_index)
-print("kits:",kits, "\nnum_trigs:", num_trigs)
-
-hw = DrumCardHardware()
+try:
+    waves, num_trigs = load_drumkit(kits, kit_index, sample_cache)
+except (OSError, ValueError) as e:  # kit manifest out of date with the files, rebuild it
+    print("load_drumkit:", e)
+    kits = find_kits(rebuild=True)
+    waves, num_trigs = load_drumkit(kits, kit_index, sample_cache)
+next_kit_index = kit_index  # kit to load in the background by kit_loader()
+next_waves = None  # set by kit_loader() when loaded, swapped in by seq_updater()
+print("kits:",kits['kit_names'], "\nnum_trigs:", num_trigs)
+
+hw = DrumCardHardware(latency=start_latency)
+if touch_calibrate:
+    print("touch sensitivities:", hw.ts20.calibrate())
+pad_velocity = PadVelocity(hw.ts20) if touch_velocity else None
+latency_tuner = LatencyTuner(hw.sample_rate)
 hw.start_synth()
+audio_clock = AudioClock(hw.sample_rate, latency_profiles[hw.latency], hw.audio_start_millis)
+# MIDI notes play on a fixed set of synth notes, oldest stolen past 'max_voices'
+note_pool = NotePool(hw.synth, max_voices=8)
+midi_debug = False  # print incoming MIDI messages (printing allocates, so it's off normally)
 #hw.startup_demo()
 hw.start_sampleplayer()
 
 pad_lit_millis = 100
+touch_scan_millis = 3  # how often touch_scanner reads the touch pads and triggers drum pads
+ui_update_millis = 50  # how often ui_handler handles the other pads and LEDs
+
+# sequencer scheduling: in deadline mode the sequencer task sleeps until just
+# before the next step is due instead of waking up every millisecond,
+# then spins for the last "seq_guard_millis" so the step isn't late
+seq_deadline_mode = True
+seq_guard_millis = 2
 pads_lit = [False] * num_trigs
 
+# drum pads share the mixer voices the synth isn't using (voice 0),
+# closed hat (pad 2) and open hat (pad 3) cut each other off
+voices = VoiceAllocator(hw.mixer, num_pads=num_trigs, reserved=1, choke_groups=((2, 3),))
+
+# map 4-bit velocity (0-15) to mixer voice level, squared for a more even loudness curve
+vel_to_level = tuple((v / 15) ** 2 for v in range(16))
+
 # callback function called by sequencer
-def drum_on(trigid, seqpos=None):
+def drum_on(trigid, seqpos=None, vel=15):
     #print("drum_on:",trigid, seqpos)
-    voice = hw.mixer.voice[trigid]   # get mixer voice
-    voice.play(waves[trigid], loop=False)
+    wave = waves[trigid]
+    if type(wave) is tuple:  # audio sync: pick how much silence to start with, if from the sequencer
+        wave = wave[audio_clock.variant(seq.step_deadline, len(wave)) if seqpos is not None else 0]
+    voices.play(trigid, wave, vel_to_level[vel], vel)
     hw.set_led(trigid, True)
     pads_lit[trigid] = True
     #gc.collect()
@@ -51,10 +119,14 @@ def drum_off(trigid, seqpos=None):
     #print("drum_off:", trigid)
     pass
 
-patterns = DrumSequencer.load_patterns("/saved_patterns.json")
+patterns = DrumSequencer.load_patterns("/saved_patterns.json", packed=True)
 seq = DrumSequencer(120, patterns, trig_on=drum_on, trig_off=drum_off)
+seq.lead_millis = seq_lead_millis if audio_sync else 0
+# saves edited patterns in the background (needs a boot.py that makes the filesystem writable)
+saver = PatternSaver(seq, "/saved_patterns.json")
 
 seq.change_pattern(1)
+#seq.set_song([(1, 2), (2, 1), (3, 1)])  # chain patterns: (pattern, repeats)
 seq.playing = True
 
 last_padlit_millis = ticks_ms()
@@ -62,7 +134,16 @@ last_debug_millis = ticks_ms()
 rec_mode = False
 rec_held = False
 
-touches = []
+touch_mask = 0
+wired_pads_mask = 0xFFFF  # only padids 0-15 make touch events
+# touch edges found by touch_scanner, read by it right away for drum pads
+# and by ui_handler at its slower rate for everything else
+touch_events = TouchEvents(size=32)
+trig_events = touch_events.reader()
+ui_events = touch_events.reader()
+# masks out ghost touches, noise, and too many pads at once, keeping the real touches
+touch_filter = TouchFilter()
+touch_late_max = 0  # most millis from a touch scan to its drum_on(), since last debug print
 
 # # play a drum sample, either by sequencer or pressing pads
 # def play_drum(num, on=True):
@@ -74,26 +155,72 @@ touches = []
 #         voice.stop()
 
 async def seq_updater():
+    global waves, next_waves
     while True:
+        if seq_deadline_mode:
+            wait_millis = seq.millis_until_step() - seq_guard_millis
+            if wait_millis > 0:
+                await asyncio.sleep(wait_millis / 1000)
+            else:
+                await asyncio.sleep(0)
+            while seq.millis_until_step() > 0:  # short tight wait for the deadline
+                pass
+        else:
+            await asyncio.sleep(0.001)
+        if next_waves and seq.millis_until_step() <= 0:  # new kit loaded, swap it in on the step
+            waves = next_waves
+            next_waves = None
         seq.update()
-        await asyncio.sleep(0.001)
+
+async def kit_loader():
+    """Load kit 'next_kit_index' in the background, one file at a time, showing progress on LEDs"""
+    global kits, kit_index, next_kit_index, next_waves
+    rebuilt = False  # kit list was just rebuilt after a load failed
+    while True:
+        await asyncio.sleep(0.05)
+        if next_kit_index == kit_index or next_waves:
+            continue
+        loading_index = next_kit_index
+        new_waves = [None] * len(kits[kits['kit_names'][loading_index]])
+        try:
+            for num_ready in iter_load_drumkit(kits, loading_index, new_waves, sample_cache):
+                for i in range(num_ready):  # light up pads as their samples are ready
+                    hw.set_led(i, True)
+                    pads_lit[i] = True
+                await asyncio.sleep(0)
+        except (OSError, ValueError) as e:
+            print("kit_loader:", e)
+            if rebuilt:  # fails with a fresh kit list too, it's the kit, give up on it
+                next_kit_index = kit_index
+                rebuilt = False
+            else:  # kit manifest may be out of date with the files, try again with a new one
+                kits = find_kits(rebuild=True)
+                next_kit_index %= len(kits['kit_names'])
+                rebuilt = True
+            continue
+        rebuilt = False
+        kit_index = loading_index
+        next_waves = new_waves
         
+async def save_handler():
+    while True:
+        await asyncio.sleep(0.1)
+        saver.update()
+
 async def midi_handler():
     while True:
         await asyncio.sleep(0.001)
         while msg := hw.midi_uart.receive() or hw.midi_usb.receive():
             if msg.type == tmidi.NOTE_ON:
-                chan = msg.channel
-                note = msg.data0
-                vel = msg.data1
-                print('NoteOn: Ch: {} Note: {} Vel:{}'.format(chan, note, vel))
-                hw.synth.press( note )
+                note_pool.press(msg.data0, msg.data1)
             elif msg.type == tmidi.NOTE_OFF:
-                chan = msg.channel
-                note = msg.data0
-                vel = msg.data1
-                print('NoteOff: Ch: {} Note: {} Vel:{}'.format(chan, note, vel))
-                hw.synth.release( note )
+                note_pool.release(msg.data0)
+            if not midi_debug:
+                continue
+            if msg.type == tmidi.NOTE_ON:
+                print('NoteOn: Ch: {} Note: {} Vel:{}'.format(msg.channel, msg.data0, msg.data1))
+            elif msg.type == tmidi.NOTE_OFF:
+                print('NoteOff: Ch: {} Note: {} Vel:{}'.format(msg.channel, msg.data0, msg.data1))
             elif msg.type == tmidi.PITCH_BEND:
                 chan = msg.channel
                 pbval = (msg.data1 << 7) | msg.data0
@@ -112,14 +239,53 @@ async def midi_handler():
             else:
                 print("unknown message:",msg)
 
+def drum_hit(i, vel, touched_millis):
+    """Play drumpad 'i' hit on the pads, and record it if recording"""
+    global touch_late_max
+    if rec_mode:
+        seq.set_trig(i, vel=vel)
+    drum_on(i, vel=vel)
+    touch_late_max = max(touch_late_max, ticks_diff(ticks_ms(), touched_millis))
+
+async def touch_scanner():
+    """Read the touch pads often, play drum pads as soon as they're pressed"""
+    global touch_mask
+    last_scan_millis = ticks_ms()
+    while True:
+        if pad_velocity and pad_velocity.busy():
+            # measuring hits, wake every millisecond to read them, play them when done
+            await asyncio.sleep(0.001)
+            done = pad_velocity.update()
+            i = 0
+            while done:
+                if done & 1:
+                    drum_hit(i, pad_velocity.vels[i], pad_velocity.touch_millis[i])
+                done >>= 1
+                i += 1
+            if ticks_diff(ticks_ms(), last_scan_millis) < touch_scan_millis: continue
+        else:
+            await asyncio.sleep(touch_scan_millis / 1000)
+        last_scan_millis = ticks_ms()
+        touch_mask = touch_filter.update(hw.read_touch_mask())
+        if not touch_events.scan(touch_mask & wired_pads_mask, last_scan_millis): continue
+        while (e := trig_events.read()) >= 0:
+            i = touch_events.pads[e]
+            if i >= 8: continue  # not a drumpad, ui_handler() does those
+            if touch_events.pressed[e]:
+                if pad_velocity:  # played by the code above once it's measured
+                    pad_velocity.start(i, hw.pad_to_channel(i), touch_events.times[e])
+                else:
+                    drum_hit(i, 15, touch_events.times[e])
+            elif rec_held:
+                seq.clear_trigs(i)
+
 async def ui_handler():
-    global rec_mode, rec_held, touches, kit_index, waves, num_trigs
+    global rec_mode, rec_held, next_kit_index
     trig_pressed = False
     last_padlit_millis = ticks_ms()
-    last_touches = hw.read_touch()
     
     while True:
-        await asyncio.sleep(0.05)
+        await asyncio.sleep(ui_update_millis / 1000)
         # update playstate
         hw.set_led(hw.LED_PLAY, seq.playing)
         hw.set_led(hw.LED_REC, rec_mode or rec_held)
@@ -133,58 +299,75 @@ async def ui_handler():
                     pads_lit[i] = False
                     hw.set_led(i, False)
 
-        touches = hw.read_touch()
-        if hw.bad_touch(): continue
-        
-        # read touchpad
-        for i, t in enumerate(touches):
-            if i > 15: continue  # not wired inputs
-            if t and not last_touches[i]:  # pressed
-                ledi = hw.pad_to_led(i)
-                hw.set_led(ledi, t)
+        # touch edges since last time, drumpads have already been played by touch_scanner()
+        while (e := ui_events.read()) >= 0:
+            i = touch_events.pads[e]
+            ledi = hw.pad_to_led(i)
+            if touch_events.pressed[e]:  # pressed
                 if i < 8:  # is drumpad, not control
                     trig_pressed = True
-                    if rec_mode:
-                        seq.set_trig(i)
-                        drum_on(i)
-                    else:
-                        drum_on(i)  # normal playing
-                elif i == hw.PAD_PLAY:
+                    continue  # LED lit by drum_on()
+                hw.set_led(ledi, True)
+                if i == hw.PAD_PLAY:
                     seq.playing = not seq.playing
                 elif i == hw.PAD_STOP:
                     seq.playing = False
                     seq.pos = 0
                 elif i == hw.PAD_REC:
                     rec_held = True
-                elif i == hw.PAD_A:
-                    seq.change_pattern(seq.patt_index+1)
-                elif i == hw.PAD_B:
-                    seq.change_pattern(seq.patt_index-1)
-                elif i == hw.PAD_UP:
-                    kit_index = (kit_index + 1) % len(kits['kit_names'])
-                    waves, num_trigs = load_drumkit(kits, kit_index)
-                    
+                elif i == hw.PAD_A:  # next pattern, at the start of next bar
+                    seq.queue_pattern(seq.pending_pattern()+1)
+                elif i == hw.PAD_B:  # previous pattern, at the start of next bar
+                    seq.queue_pattern(seq.pending_pattern()-1)
+                elif i == hw.PAD_UP:  # next kit, loaded in the background by kit_loader()
+                    next_kit_index = (next_kit_index + 1) % len(kits['kit_names'])
             
-            if not t and last_touches[i]: # released
-                ledi = hw.pad_to_led(i)
-                hw.set_led(ledi, t)
-                if i< 8:
-                    if rec_held:
-                        seq.clear_trigs(i)
-                        
-                elif i == hw.PAD_REC:
+            else: # released
+                hw.set_led(ledi, False)
+                if i == hw.PAD_REC:
                     rec_held = False
                     if trig_pressed:
                         trig_pressed = False
                     else:
                         rec_mode = not rec_mode
-                
-        last_touches = touches
-
         
+async def latency_handler():
+    """Measure how long the event loop gets held up, for picking the mixer buffer size"""
+    sleep_millis = 5
+    last_millis = ticks_ms()
+    while True:
+        await asyncio.sleep(sleep_millis / 1000)
+        now = ticks_ms()
+        latency_tuner.note_stall(ticks_diff(now, last_millis) - sleep_millis, now)
+        last_millis = now
+        if audio_latency == 'auto':
+            # only shrink the buffer when stopped, changing it makes a click
+            latency = latency_tuner.pick(hw.latency, allow_smaller=not seq.playing)
+            if hw.set_latency(latency):
+                voices.set_mixer(hw.mixer)
+                audio_clock.restart(latency_profiles[hw.latency], hw.audio_start_millis)
+                print("audio latency:", latency, "%d ms" % hw.latency_millis())
+
 async def debug_handler():
+    global touch_late_max
     while True:
-        print("debug: ", touches)
+        print("debug: touches %06x" % touch_mask)
+        print("touch: scan-to-trigger max %d ms, events dropped: %d, touches filtered: %d" % (
+            touch_late_max, ui_events.num_dropped + trig_events.num_dropped, touch_filter.num_rejected))
+        touch_late_max = 0
+        if pad_velocity:  # for tuning full_rate
+            print("pad velocity: last rate", pad_velocity.last_rate, "full_rate", pad_velocity.full_rate)
+        # sequencer wakeups per second and how late steps were played
+        steps = max(seq.num_steps_played, 1)
+        print("seq: wakeups:", seq.num_updates, "steps:", seq.num_steps_played,
+              "late avg/max: %.2f/%d ms" % (seq.step_late_total / steps, seq.step_late_max))
+        seq.reset_stats()
+        print("voices stolen:", voices.num_steals, "synth notes stolen:", note_pool.num_steals)
+        # pad touch to sound: touch scan interval + worst case mixer buffering
+        print("audio latency: %s, worst stall %d ms, touch-to-sound up to %d ms" % (
+            hw.latency, latency_tuner.worst_stall(), touch_scan_millis + hw.latency_millis()))
+        if sample_cache:
+            print(sample_cache)
         await asyncio.sleep(1)
         
     #     #print("%.2f %.2f" % (time.monotonic(), dt), touches)
@@ -203,7 +386,11 @@ async def main():
     task3 = asyncio.create_task(midi_handler())
     task4 = asyncio.create_task(seq_updater())
     task5 = asyncio.create_task(debug_handler())
-    await asyncio.gather(task2, task3, task4, task5)
+    task6 = asyncio.create_task(save_handler())
+    task7 = asyncio.create_task(kit_loader())
+    task8 = asyncio.create_task(latency_handler())
+    task9 = asyncio.create_task(touch_scanner())
+    await asyncio.gather(task2, task3, task4, task5, task6, task7, task8, task9)
 
 asyncio.run(main())
 
@@ -3,20 +3,51 @@
 # Drum kit management
 #
 import os
+import json
+import struct
+from array import array
 import audiocore
 
-def find_kits(kit_root="/drumkits", num_pads=8):
+def find_kits(kit_root="/drumkits", num_pads=8, use_index=True, rebuild=False):
     """
     Search a given drum kit directory for subdirs containing drum kits
     Then load up the drum kit info into "kits" data struct:
     keys = kit names, values = list of WAV sample filenames
-    also special key "kit_names" as ordered list of kit names.
+    also special key "kit_names" as ordered list of kit names,
+    "wav_info" dict of filename -> read_wav_info() for each sample,
+    and "blobs" dict of kit name -> "kit.bin" file, for kits that have one
+    (made by host_tools/pack_kits.py, all of a kit's samples in one file).
 
     Kit directories should be named like:
       00kick, 01snare, 02hatC, 03hatO, 04clap, 05tomL, 06ride, 07crash,
     if there aren't 8 smamples, it will not add the kit
+
+    The result is kept in the manifest file "kit_root/.index", so later boots
+    don't have to list every kit directory or read any WAV headers, only stat
+    each kit dir. It's rebuilt if a kit directory is added, removed or its
+    mtime changes. Sample files are only checked when their kit is loaded,
+    see check_kit_files(). Delete it or pass rebuild=True to force a rebuild.
+    If the manifest can't be written (CIRCUITPY is read-only to code unless
+    boot.py remounts it), "wav_info" is left empty and WAV headers are read
+    when a kit is loaded, instead of every kit's at every boot.
     """
+    if not use_index:
+        return scan_kits(kit_root, num_pads)
+    index_path = kit_root + "/.index"
+    stamps = kit_stamps(kit_root)
+    kits = None if rebuild else read_kit_index(index_path, stamps)
+    if kits is None:
+        print("find_kits: rebuilding", index_path)
+        kits = scan_kits(kit_root, num_pads)
+        kits['wav_info'] = {}
+        write_kit_index(index_path, kits, stamps, num_pads)
+    return kits
+
+
+def scan_kits(kit_root="/drumkits", num_pads=8):
+    """List all kit directories to make a "kits" data struct, see find_kits()"""
     kits = {}
+    blobs = {}
     for kitname in sorted(os.listdir(kit_root)):
         kname = kitname.lower()
         if not kname.startswith("kit"): # ignore non-kit dirs
@@ -26,32 +57,404 @@ def find_kits(kit_root="/drumkits", num_pads=8):
             samplename = samplename.lower()
             if samplename.endswith(".wav") and not samplename.startswith("."):
                 kits[kname].append(f"{kit_root}/{kname}/{samplename}") # add it to the bag!
+            elif samplename == "kit.bin":
+                blobs[kname] = f"{kit_root}/{kname}/{samplename}"
         if len(kits[kname]) < num_pads:
             print(f"ERROR: kit '{kname}' not enough samples! Removing...")
             del kits[kname]
+            blobs.pop(kname, None)
     kits['kit_names'] = sorted(kits.keys())  # add special key of sorted names
+    kits['blobs'] = blobs
     return kits
 
 
-def load_drumkit(kits, kit_index):
+def kit_stamps(kit_root="/drumkits"):
+    """
+    Cheap fingerprint of the kit directories, to tell if the manifest is stale:
+    list of [name, mtime] for each kit dir, one listdir() and a stat() per kit
+    """
+    stamps = []
+    for kitname in sorted(os.listdir(kit_root)):
+        if kitname.lower().startswith("kit"):
+            stamps.append([kitname, os.stat(f"{kit_root}/{kitname}")[8]])
+    return stamps
+
+
+def read_kit_index(index_path, stamps):
+    """
+    Return "kits" data struct from a manifest file, or None if missing or stale.
+    Only the kit dir stamps are checked, sample files are checked when loaded.
+    """
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if index.get('stamps') != stamps:
+        return None
+    kits = {'kit_names': index['kit_names'], 'wav_info': {}, 'blobs': index.get('blobs', {}),
+            'file_stamps': index.get('files', {})}
+    for kname in kits['kit_names']:
+        kits[kname] = []
+        for entry in index['kits'][kname]:  # [fname, rate, channels, bits, offset, len]
+            kits[kname].append(entry[0])
+            kits['wav_info'][entry[0]] = tuple(entry[1:])
+    return kits
+
+
+def write_kit_index(index_path, kits, stamps, num_pads=8):
+    """
+    Read the WAV headers of all kits into kits['wav_info'] and save "kits" as
+    manifest file. If the filesystem isn't writable, does neither.
+    Samples that can't be read are left out of their kit, and kits left with
+    fewer than 'num_pads' samples are removed, same as scan_kits() does.
+    Written to a temp file then renamed, so a failed write doesn't leave a
+    broken manifest. Returns True if written
+    """
+    tmp_path = index_path + ".tmp"
+    try:
+        fp = open(tmp_path, 'w')
+    except OSError as e:
+        print("find_kits: could not write", index_path, e)
+        return False
+    with fp:
+        files = {}
+        for kname in list(kits['kit_names']):
+            good = []
+            for fname in kits[kname]:
+                try:
+                    kits['wav_info'][fname] = read_wav_info(fname)
+                    st = os.stat(fname)
+                except (OSError, ValueError) as e:
+                    print("find_kits: skipping", fname, e)
+                    continue
+                good.append(fname)
+                files[fname] = [st[6], st[8]]
+            kits[kname] = good
+            if len(good) < num_pads:
+                print(f"ERROR: kit '{kname}' not enough samples! Removing...")
+                del kits[kname]
+                kits['kit_names'].remove(kname)
+                kits['blobs'].pop(kname, None)
+            elif kname in kits['blobs']:
+                try:
+                    st = os.stat(kits['blobs'][kname])
+                    files[kits['blobs'][kname]] = [st[6], st[8]]
+                except OSError:
+                    del kits['blobs'][kname]
+        index = {'stamps': stamps, 'kit_names': kits['kit_names'], 'blobs': kits['blobs'],
+                 'kits': {}, 'files': files}
+        for kname in kits['kit_names']:
+            index['kits'][kname] = [[fname] + list(kits['wav_info'][fname])
+                                      for fname in kits[kname]]
+        json.dump(index, fp)
+    kits['file_stamps'] = files
+    try:
+        os.remove(index_path)  # FAT can't rename over an existing file
+    except OSError:
+        pass
+    os.rename(tmp_path, index_path)
+    return True
+
+
+def check_kit_files(kits, kit_name):
+    """
+    Check a kit's sample files against the manifest before loading it.
+    Kit dir mtimes aren't reliably updated on FAT when files in them change,
+    so each file is stat()ed and checked against its size and mtime, just for
+    the kit being loaded instead of every kit at boot. A changed sample's
+    WAV info is dropped so its header is read again, a changed "kit.bin" isn't
+    used. A missing file raises OSError, rebuild the manifest then.
+    """
+    file_stamps = kits.get('file_stamps')
+    if not file_stamps:
+        return
+    fnames = kits[kit_name]
+    blob = kits['blobs'].get(kit_name)
+    for fname in (fnames + [blob]) if blob else fnames:
+        st = os.stat(fname)
+        stamp = file_stamps.get(fname)  # [size, mtime]
+        if stamp and st[6] == stamp[0] and st[8] == stamp[1]:
+            continue
+        print("load_drumkit: changed", fname)
+        if fname == blob:
+            del kits['blobs'][kit_name]
+        else:
+            kits['wav_info'].pop(fname, None)
+        file_stamps[fname] = [st[6], st[8]]
+
+
+def load_drumkit(kits, kit_index, cache=None):
     """
     Load WaveFile objects upfront into waves array, by kit index,
-    in attempt to reduce play latency
+    in attempt to reduce play latency.
+    If a SampleCache is given, play samples from RAM instead, as many as fit,
+    reading the kit's "kit.bin" in one go if it has one and it fits.
+    """
+    waves = [None] * len(kits[kits['kit_names'][kit_index]])
+    for _ in iter_load_drumkit(kits, kit_index, waves, cache):
+        pass
+    return waves, len(waves)
+
+
+def iter_load_drumkit(kits, kit_index, waves, cache=None):
+    """
+    Like load_drumkit() but a generator that opens one file per iteration,
+    so an async task can load a kit a little at a time.
+    Fills in the given 'waves' list, yields how many pads are ready so far.
     """
     print("load_drumkit:", kit_index)
     kit_name = kits['kit_names'][kit_index]
-    num_pads = len(kits[kit_name])
-    waves = [None] * num_pads
-    for i in range(num_pads):
-        fname = kits[kit_name][i]
-        waves[i] = audiocore.WaveFile(fname)
-    return waves, num_pads
-
-# # play a drum sample, either by sequencer or pressing pads
-# def play_drum(num, pressed):
-#     pads_lit[num] = pressed
-#     voice = mixer.voice[num]   # get mixer voice
-#     if pressed and not pads_mute[num]:
-#         voice.play(waves[num],loop=False)
-#     else: # released
-#         pass   # not doing this for samples
+    check_kit_files(kits, kit_name)
+    fnames = kits[kit_name]
+    if cache is not None and kit_name in kits.get('blobs', ()):
+        for _ in cache.iter_load_blob(kits['blobs'][kit_name], waves):
+            yield len(waves) - waves.count(None)
+    if cache is not None:
+        for _ in cache.iter_load_kit(fnames, waves, kits.get('wav_info')):
+            yield len(waves) - waves.count(None)
+    for i in range(len(waves)):
+        if waves[i] is None:
+            waves[i] = audiocore.WaveFile(fnames[i])
+            yield len(waves) - waves.count(None)
+
+
+def read_wav_info(fname):
+    """
+    Read header of a WAV file, return tuple of
+    (sample_rate, channel_count, bits_per_sample, data_offset, data_len)
+    """
+    with open(fname, 'rb') as fp:
+        hdr = fp.read(12)
+        if len(hdr) < 12:
+            raise ValueError("not a WAV file: " + fname)
+        riff, _, wave = struct.unpack('<4sI4s', hdr)
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError("not a WAV file: " + fname)
+        fmt = None
+        while True:
+            hdr = fp.read(8)
+            if len(hdr) < 8:
+                raise ValueError("no data in WAV file: " + fname)
+            chunk_id, chunk_len = struct.unpack('<4sI', hdr)
+            if chunk_id == b'fmt ':
+                if chunk_len < 16:
+                    raise ValueError("bad fmt in WAV file: " + fname)
+                fmt = struct.unpack('<HHIIHH', fp.read(16))
+                fp.seek(chunk_len - 16 + (chunk_len & 1), 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("no fmt before data in WAV file: " + fname)
+                _, channels, rate, _, _, bits = fmt
+                return rate, channels, bits, fp.tell(), chunk_len
+            else:
+                fp.seek(chunk_len + (chunk_len & 1), 1)  # chunks are word-aligned
+
+
+def load_raw_sample(fname, info=None, pad=0, pad_step=32):
+    """
+    Read a WAV file's sample data into RAM, return an audiocore.RawSample.
+    'info' is the result of read_wav_info() if you already have it.
+    If 'pad' is given, returns a tuple of RawSamples, see make_padded_variants().
+    """
+    rate, channels, bits, offset, nbytes = info or read_wav_info(fname)
+    if bits != 16 and (bits != 8 or pad):
+        raise ValueError("unsupported bits per sample %d: %s" % (bits, fname))
+    pad_len = pad * channels  # array items of silence in front
+    if bits == 16:
+        # MicroPython builds an array from a bytearray's raw bytes, so this is nbytes/2 zeros
+        buf = array('h', bytearray(nbytes + pad_len * 2))
+    else:
+        buf = array('B', bytearray(nbytes))  # 8-bit WAVs are unsigned
+    with open(fname, 'rb') as fp:
+        fp.seek(offset)
+        fp.readinto(memoryview(buf)[pad_len:] if pad else buf)
+    if pad:
+        return make_padded_variants(memoryview(buf), pad, pad_step, channels, rate)
+    return audiocore.RawSample(buf, channel_count=channels, sample_rate=rate)
+
+
+def make_padded_variants(mv, pad, pad_step, channels, rate):
+    """
+    Given a memoryview of 16-bit sample data starting with 'pad' samples of
+    silence, return a tuple of RawSamples of it with 0, pad_step, 2*pad_step...
+    samples of silence in front, for starting a hit a little later than when
+    it's played, see audio_clock.AudioClock. All share the same sample data.
+    """
+    return tuple(audiocore.RawSample(mv[(pad - j * pad_step) * channels:],
+                                     channel_count=channels, sample_rate=rate)
+                 for j in range(pad // pad_step + 1))
+
+
+def read_kit_blob_info(fname):
+    """
+    Read header of a "kit.bin" made by host_tools/pack_kits.py, return tuple of
+    (sample_rate, channel_count, sample_table, data_offset, data_len)
+    where sample_table is a list of (offset, len) of each sample, in bytes from data_offset.
+    The file is little-endian:
+      "DKIT", u16 version, u16 num_samples, u32 sample_rate, u16 channels, u16 bits,
+      num_samples * (u32 offset, u32 len), then the 16-bit sample data
+    with the sample offsets counted from the start of the sample data
+    """
+    with open(fname, 'rb') as fp:
+        magic, version, num_samples, rate, channels, bits = struct.unpack('<4sHHIHH', fp.read(16))
+        if magic != b'DKIT' or version != 1 or bits != 16:
+            raise ValueError("not a version 1 16-bit kit.bin: " + fname)
+        table = []
+        for _ in range(num_samples):
+            table.append(struct.unpack('<II', fp.read(8)))
+        data_offset = fp.tell()
+        data_len = fp.seek(0, 2) - data_offset
+    return rate, channels, table, data_offset, data_len
+
+
+def load_kit_blob(fname, info=None, pad=0, pad_step=32):
+    """
+    Read all samples of a "kit.bin" into RAM with one read,
+    return list of audiocore.RawSample, one per sample.
+    'info' is the result of read_kit_blob_info() if you already have it.
+    If 'pad' is given, the list is of tuples of RawSamples, see make_padded_variants(),
+    and each sample is read separately, to leave room for silence in front of it.
+    """
+    rate, channels, table, data_offset, data_len = info or read_kit_blob_info(fname)
+    pad_len = pad * channels  # array items of silence in front of each sample
+    buf = array('h', bytearray(data_len + pad_len * 2 * len(table)))  # see load_raw_sample()
+    mv = memoryview(buf)
+    samples = []
+    with open(fname, 'rb') as fp:
+        fp.seek(data_offset)
+        if not pad:
+            fp.readinto(buf)
+        for k, (off, n) in enumerate(table):
+            start = off // 2 + k * pad_len  # where the silence in front of sample k starts
+            end = start + pad_len + n // 2
+            if pad:
+                fp.seek(data_offset + off)
+                fp.readinto(mv[start + pad_len:end])
+                samples.append(make_padded_variants(mv[start:end], pad, pad_step, channels, rate))
+            else:
+                samples.append(audiocore.RawSample(mv[start:end],
+                                                   channel_count=channels, sample_rate=rate))
+    return samples
+
+
+class SampleCache:
+    """
+    Keep drum samples decoded in RAM as audiocore.RawSample objects, so playing
+    a sample doesn't read flash. Holds at most 'budget' bytes of sample data,
+    evicting the least-recently-used samples (e.g. from the previous kit)
+    when a new kit needs room. Samples that don't fit stream from WaveFile instead.
+    If 'pad' is given, samples are kept with that much silence in front and are
+    tuples of RawSamples, see make_padded_variants(), to use with audio_clock.AudioClock.
+    """
+    def __init__(self, budget=48_000, pad=0, pad_step=32):
+        self.budget = budget  # max bytes of sample data to keep in RAM
+        self.pad = pad  # samples of silence in front of each sample
+        self.pad_step = pad_step
+        self.samples = {}  # filename -> RawSample, or tuple of them if padded
+        self.sizes = {}  # filename -> bytes used
+        self.last_used = {}  # filename -> use count when last used, for LRU
+        self.use_count = 0
+        self.bytes_resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.num_streamed = 0  # kit samples that didn't fit, so stream from flash
+
+    def __str__(self):
+        return "SampleCache: %d samples, %d/%d bytes, %d hits, %d misses, %d streamed" % (
+            len(self.samples), self.bytes_resident, self.budget,
+            self.hits, self.misses, self.num_streamed)
+
+    def _evict(self, nbytes, keep):
+        """Evict least-recently-used samples not in 'keep' until 'nbytes' fit, or none left"""
+        while self.bytes_resident + nbytes > self.budget:
+            lru = None
+            for fname in self.samples:
+                if fname not in keep and (lru is None or
+                                          self.last_used[fname] < self.last_used[lru]):
+                    lru = fname
+            if lru is None:
+                return
+            self.bytes_resident -= self.sizes[lru]
+            del self.samples[lru], self.sizes[lru], self.last_used[lru]
+
+    def load_kit(self, fnames, wav_info=None):
+        """
+        Return list of RawSamples for a kit's sample files, loading any
+        not already cached. Samples that don't fit in the budget are None
+        in the list, for the caller to stream from a WaveFile instead.
+        'wav_info' is an optional dict of filename -> read_wav_info(), to skip reading headers.
+        """
+        waves = [None] * len(fnames)
+        for _ in self.iter_load_kit(fnames, waves, wav_info):
+            pass
+        return waves
+
+    def iter_load_kit(self, fnames, waves, wav_info=None):
+        """
+        Generator version of load_kit(), fills in 'waves' opening one file per iteration.
+        Evicted samples stay playable in the caller's old waves list until it drops them.
+        """
+        infos = {}
+        kit_bytes = 0  # bytes of this kit already cached
+        for i, fname in enumerate(fnames):
+            if waves[i] is not None:  # already loaded, e.g. from a kit.bin
+                continue
+            if fname in self.samples:
+                kit_bytes += self.sizes[fname]
+                waves[i] = self._use(fname)
+                self.hits += 1
+            elif wav_info and fname in wav_info:
+                infos[fname] = wav_info[fname]
+            else:
+                infos[fname] = read_wav_info(fname)
+                yield
+        # bytes each sample will take, with any silence in front
+        sizes = {f: infos[f][4] + self.pad * infos[f][1] * 2 for f in infos}
+        # cache the smallest samples first, so as many pads as possible play from RAM
+        to_load = []
+        for fname in sorted(sizes, key=lambda f: sizes[f]):
+            if kit_bytes + sizes[fname] > self.budget:
+                break
+            kit_bytes += sizes[fname]
+            to_load.append(fname)
+        self._evict(sum(sizes[f] for f in to_load), fnames)
+        for fname in to_load:
+            nbytes = sizes[fname]
+            self.samples[fname] = load_raw_sample(fname, infos[fname], self.pad, self.pad_step)
+            self.sizes[fname] = nbytes
+            self.bytes_resident += nbytes
+            self.misses += 1
+            waves[fnames.index(fname)] = self._use(fname)
+            yield
+        self.num_streamed += len(infos) - len(to_load)
+
+    def iter_load_blob(self, blob_path, waves):
+        """
+        Like iter_load_kit() but for a "kit.bin" made by host_tools/pack_kits.py,
+        which is read in one go. Leaves 'waves' alone if the kit.bin doesn't fit.
+        """
+        if blob_path in self.samples:
+            self.hits += 1
+        else:
+            info = read_kit_blob_info(blob_path)
+            nbytes = info[4] + self.pad * info[1] * 2 * len(info[2])
+            if nbytes > self.budget:
+                print("SampleCache: %s is %d bytes, budget %d" % (blob_path, nbytes, self.budget))
+                return
+            yield
+            self._evict(nbytes, ())
+            self.samples[blob_path] = load_kit_blob(blob_path, info, self.pad, self.pad_step)
+            self.sizes[blob_path] = nbytes
+            self.bytes_resident += nbytes
+            self.misses += 1
+        samples = self._use(blob_path)
+        for i in range(min(len(waves), len(samples))):
+            waves[i] = samples[i]
+        yield
+
+    def _use(self, fname):
+        """Mark a cached sample as just used, for LRU, and return it"""
+        self.use_count += 1
+        self.last_used[fname] = self.use_count
+        return self.samples[fname]
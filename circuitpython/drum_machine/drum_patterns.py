@@ -87,4 +87,22 @@ patterns_demo = [
             '0000 0000 0000 0000  0000 0000 0000 0010', # cy
         ],
     },
+    {
+        'name': 'poly1',
+        'seq': [
+            # steps      11 1111  1111 2222 2222 2233
+            #0123 4567 8901 2345  6789 0123 4567 8901
+            '1000 0000 1000 0000  1000 0000 1000 0000', # bd
+            '0000 0000 1000 0000  0000 0000 1000 0000', # sd
+            '1010 0010 1000 0000  0000 0000 0000 0000', # oh  (12 steps)
+            '0000 0000 0000 0000  0000 0000 0000 0000', # ch
+
+            '0000 0000 0000 0000  0000 0000 0000 0000', # cl
+            '1001 0000 0000 0000  0000 0000 0000 0000', # tm  (5 steps)
+            '0000 0000 0000 0000  0000 0000 0000 0000', # cw
+            '1000 0000 0000 0000  0000 0000 0000 0000', # cy  (32 steps at half speed)
+        ],
+        'lens': [32, 32, 12, 32,  32, 5, 32, 32],
+        'divs': [ 1,  1,  1,  1,   1, 1,  1,  2],
+    },
 ]
@@ -1,4 +1,7 @@
 
+import os
+import json
+from array import array
 from adafruit_ticks import ticks_ms, ticks_diff, ticks_add
 import drum_patterns
 
@@ -6,40 +9,180 @@ import drum_patterns
 debug = True
 
 # stub function so you can opt to not pass in a trig_on or trig_off function
-def trigstub(padid, pos):  pass
+def trigstub(padid, pos, vel=15):  pass
 
 class DrumSequencer():
     """
+    trig_on is called as trig_on(padid, pos, vel), with velocity 0-15,
+    trig_off is called as trig_off(padid, pos), for each pad triggered on the
+    last step, by the first update() more than 2 ms after it, or by the next step's
+    update() if there wasn't one in between (e.g. seq_updater's deadline sleeping)
+    Steps are played 'lead_millis' early; in trig_on, 'step_deadline' is when the step is due
     """
-    def __init__(self, bpm, patterns, trig_on=None, trig_off=None):
-        self.last_step_millis = ticks_ms()
+    def __init__(self, bpm, patterns, trig_on=None, trig_off=None, lookahead=4):
+        self.last_step_millis = ticks_ms()  # when the last step was scheduled
+        self.next_step_millis = self.last_step_millis  # when the next step is due
+        self.bar_start_millis = self.last_step_millis  # when the current bar started
+        self.bar_phase = 0  # fractional millis carried between bars, in 1/step_denom units
+        self.step_late = 0  # how late (in millis) the last step was actually played
+        self.lead_millis = 0  # play steps this early, for trig_on to schedule against step_deadline
+        self.step_deadline = self.last_step_millis  # when the step being played is due, in ticks_ms
+        self.reset_stats()
         self.playing = False
         self.recording = False
         self.steps_per_beat = 8  # divisions per beat: 8 = 32nd notes, 4 = 16th notes
         self.patterns = patterns
         self.num_patterns = len(patterns)
+        self.dirty = bytearray(self.num_patterns)  # which patterns were edited since saved
+        self.last_edit_millis = ticks_ms()
         self.pos = 0  # where in our sequence we are
         self.trig_on = trig_on if trig_on is not None else trigstub
         self.trig_off = trig_off if trig_off is not None else trigstub
+        self.sequence = None
+        self._step_tables = {}  # cache of step time tables, key is (patt_index, step_denom)
         self.set_bpm(bpm)
-        
+
         # first pattern determines number of steps & pads in all sequences
+        first_seq = patterns[0]['seq']
+        self.num_steps = len(first_seq)
+        if isinstance(first_seq[0], list):
+            self.num_pads = len(first_seq[0])
+        else:
+            self.num_pads = patterns[0].get('pads', 8)
+        self.triggered = 0  # bitmask of which pads are triggered
+        self.velocity = None  # velocity lane of current pattern, None if all full
+
+        # lookahead queue: ring buffer of the trig masks & velocities for the next
+        # few steps, filled in idle time so a step boundary only has to pop a ready mask
+        self.lookahead = max(lookahead, 1)
+        self._la_pos = array('H', (0 for _ in range(self.lookahead)))  # step of each entry
+        self._la_mask = array('H', (0 for _ in range(self.lookahead)))  # trig mask of each entry
+        self._la_vel = bytearray(self.lookahead * self.num_pads)  # velocity per pad of each entry
+        self._la_head = 0  # index of next entry to pop
+        self._la_count = 0  # how many entries are ready
+        self._la_fill_pos = 0  # step to compute next
+
+        # polymeter: each track (pad) can have its own length and clock divider.
+        # "tick" counts steps since the pattern started, and the lookahead
+        # keeps a cursor of each track's position and divider count
+        self.tick = 0
+        self.polymeter = False
+
+        # song mode: list of (patt_index, repeats) to chain through, and
+        # the pattern queued to start at the next bar, resolved before the bar ends
+        self.song = None
+        self.song_pos = 0  # which entry of song is playing
+        self.song_repeat = 0  # how many times current entry has played
+        self.next_patt_index = None  # pattern to switch to at next bar, or None
+        self._next_step_table = None  # step table of next_patt_index, ready to go
+        self.track_lens = bytearray(self.num_pads)
+        self.track_divs = bytearray(self.num_pads)
+        self._la_tpos = bytearray(self.num_pads)  # next step each track plays
+        self._la_tdiv = bytearray(self.num_pads)  # divider count of each track
+
         self.change_pattern(0)
-        self.num_steps = len(self.sequence)
-        self.num_pads = len(self.sequence[0])
-        self.triggered = [False] * self.num_pads  # which pads are triggered       
-        
-    def change_pattern(self,patt_index):
-        self.patt_index = patt_index % self.num_patterns
-        self.sequence = self.patterns[self.patt_index]['seq']
 
-    def set_trig(self, trigid, val= True, pos=None):
+    def change_pattern(self,patt_index):
+        """Switch to pattern right now, see queue_pattern() to switch on the bar"""
+        self.next_patt_index = None
+        self._set_pattern(patt_index % self.num_patterns)
+        self._retime()
+
+    def queue_pattern(self, patt_index):
+        """Switch to pattern at the start of the next bar"""
+        patt_index = patt_index % self.num_patterns
+        self._next_step_table = self._step_table(patt_index)
+        self.next_patt_index = patt_index
+
+    def pending_pattern(self):
+        """Return index of pattern queued for next bar, or current pattern if none"""
+        return self.patt_index if self.next_patt_index is None else self.next_patt_index
+
+    def set_song(self, song):
+        """
+        Chain patterns into a song: 'song' is a list of (patt_index, repeats),
+        e.g. [(0,4), (1,3), (0,1)]. Starts at next bar. None to stop song mode.
+        """
+        self.song = song
+        self.song_pos = 0
+        self.song_repeat = -1  # current bar isn't part of the song yet
+        if song:
+            self.queue_pattern(song[0][0])
+
+    def _resolve_next_pattern(self):
+        """Before the bar ends, work out what song mode plays next bar"""
+        if not self.song:
+            return
+        self.song_repeat += 1
+        if self.song_repeat >= self.song[self.song_pos][1]:
+            self.song_repeat = 0
+            self.song_pos = (self.song_pos + 1) % len(self.song)
+        patt_index = self.song[self.song_pos][0]
+        if self.next_patt_index is None and patt_index != self.patt_index:
+            self.queue_pattern(patt_index)
+
+    def _set_pattern(self, patt_index):
+        """Make pattern current. Doesn't allocate, so it's safe on a bar boundary"""
+        self.patt_index = patt_index
+        patt = self.patterns[self.patt_index]
+        self.sequence = patt['seq']
+        self.velocity = patt.get('vel')
+        # packed sequences are one int bitmask per step instead of a list of trigs
+        self.packed = not isinstance(self.sequence[0], list)
+        # per-track lengths & clock dividers, legacy patterns have all tracks equal
+        lens = patt.get('lens')
+        divs = patt.get('divs')
+        self.polymeter = False
+        for i in range(self.num_pads):
+            self.track_lens[i] = min(lens[i], self.num_steps) if lens else self.num_steps
+            self.track_divs[i] = max(divs[i], 1) if divs else 1
+            if self.track_lens[i] != self.num_steps or self.track_divs[i] != 1:
+                self.polymeter = True
+        self.tick = self.pos
+        self.flush_lookahead()
+
+    def track_step(self, trigid, tick):
+        """Return which step of track 'trigid' plays at 'tick'"""
+        return (tick // self.track_divs[trigid]) % self.track_lens[trigid]
+
+    def set_trig(self, trigid, val= True, pos=None, vel=15):
+        self._mark_dirty()
         if pos is None:
-            pos = self.pos
-        if self.playing:
+            if self.polymeter:
+                # it's always in the future when playing
+                tick = self.tick - 1 if self.playing else self.tick
+                pos = self.track_step(trigid, tick)
+            else:
+                pos = self.pos - 1 if self.playing else self.pos
+        elif self.playing:
             pos = pos-1  # it's always in the future when playing
-        self.sequence[pos][trigid] = val
-        
+        if self.packed:
+            if val:
+                self.sequence[pos] |= (1 << trigid)
+            else:
+                self.sequence[pos] &= ~(1 << trigid)
+        else:
+            self.sequence[pos][trigid] = val
+        pos = pos % self.num_steps
+        if self.velocity is None and val and vel != 15:  # first non-full hit, make a lane
+            self.velocity = make_velocity_lane(self.num_steps, self.num_pads)
+            self.patterns[self.patt_index]['vel'] = self.velocity
+        if self.velocity is not None:
+            set_velocity(self.velocity, self.num_pads, pos, trigid, vel)
+        if self.polymeter:
+            # queue entries don't map to one track step, just redo them
+            self.flush_lookahead()
+            return
+        # patch any queued entry for this step so live recording isn't lost
+        for k in range(self._la_count):
+            j = (self._la_head + k) % self.lookahead
+            if self._la_pos[j] == pos:
+                if val:
+                    self._la_mask[j] |= (1 << trigid)
+                    self._la_vel[j * self.num_pads + trigid] = vel
+                else:
+                    self._la_mask[j] &= ~(1 << trigid)
+
     # def toggle_trig(self, trigid, pos=None):
     #     if pos is None:
     #         pos = self.pos
@@ -47,53 +190,304 @@ class DrumSequencer():
     #         pos = pos-1  # it's always in the future when playing
     #     self.sequence[pos][trigid] = not self.sequence[pos][trigid]
 
+    def _mark_dirty(self):
+        self.dirty[self.patt_index] = 1
+        self.last_edit_millis = ticks_ms()
+
     def clear_trigs(self, trigid):
-        for i in range(self.num_steps):
-            self.sequence[i][trigid] = 0
+        self._mark_dirty()
+        if self.packed:
+            keep = ~(1 << trigid)
+            for i in range(self.num_steps):
+                self.sequence[i] &= keep
+        else:
+            for i in range(self.num_steps):
+                self.sequence[i][trigid] = 0
+        keep = ~(1 << trigid)
+        for j in range(self.lookahead):
+            self._la_mask[j] &= keep
+
+    def step_mask(self, pos):
+        """Return bitmask of pads triggered at step 'pos' of current sequence"""
+        step_line = self.sequence[pos]
+        if self.packed:
+            return step_line
+        mask = 0
+        for i in range(self.num_pads):
+            if step_line[i]:
+                mask |= (1 << i)
+        return mask
+
+    def step_velocity(self, trigid, pos):
+        """Return velocity (0-15) of pad 'trigid' at step 'pos' of current sequence"""
+        if self.velocity is None:
+            return 15
+        return get_velocity(self.velocity, self.num_pads, pos, trigid)
+
+    def _poly_step_mask(self, vels):
+        """
+        Return bitmask of pads triggered at the lookahead cursor, and advance it.
+        Velocities of triggered pads go into _la_vel starting at index 'vels'
+        """
+        seq = self.sequence
+        mask = 0
+        for i in range(self.num_pads):
+            if self._la_tdiv[i] == 0:  # this track's clock ticks
+                p = self._la_tpos[i]
+                if (seq[p] >> i) & 1 if self.packed else seq[p][i]:
+                    mask |= (1 << i)
+                    self._la_vel[vels + i] = self.step_velocity(i, p)
+                p += 1
+                if p == self.track_lens[i]:
+                    p = 0
+                self._la_tpos[i] = p
+            c = self._la_tdiv[i] + 1
+            if c == self.track_divs[i]:
+                c = 0
+            self._la_tdiv[i] = c
+        return mask
+
+    def _next_fill_mask(self, j):
+        """
+        Return bitmask of pads triggered at the lookahead cursor, and advance it.
+        Velocities of triggered pads go into entry 'j' of the queue.
+        """
+        pos = self._la_fill_pos
+        vels = j * self.num_pads
+        if self.polymeter:
+            mask = self._poly_step_mask(vels)
+        else:
+            mask = self.step_mask(pos)
+            m = mask
+            i = 0
+            while m:
+                if m & 1:
+                    self._la_vel[vels + i] = self.step_velocity(i, pos)
+                m >>= 1
+                i += 1
+        self._la_fill_pos = (pos + 1) % self.num_steps
+        return mask
+
+    def flush_lookahead(self):
+        """Throw away queued step masks, e.g. when the sequence changes"""
+        self._la_count = 0
+        self._la_fill_pos = self.pos
+        if self.polymeter:
+            # put each track's cursor where it will be at the current tick
+            tick = self.tick
+            for i in range(self.num_pads):
+                div = self.track_divs[i]
+                self._la_tdiv[i] = tick % div
+                self._la_tpos[i] = ((tick + div - 1) // div) % self.track_lens[i]
+
+    def prefill(self):
+        """Compute trig masks for upcoming steps into the lookahead queue"""
+        while self._la_count < self.lookahead:
+            j = (self._la_head + self._la_count) % self.lookahead
+            self._la_pos[j] = self._la_fill_pos
+            self._la_mask[j] = self._next_fill_mask(j)
+            self._la_count += 1
+
+    def _pop_lookahead(self):
+        """
+        Return index of queued entry for the current step,
+        its trig mask is in _la_mask[j], velocities start at _la_vel[j*num_pads]
+        """
+        j = self._la_head
+        if not (self._la_count and self._la_pos[j] == self.pos):
+            # queue is empty or stale, start it over from this step
+            if self._la_count:  # pos was changed out from under us, restart the tracks too
+                self.tick = self.pos
+            self.flush_lookahead()
+            self.prefill()
+            j = self._la_head
+        self._la_head = (j + 1) % self.lookahead
+        self._la_count -= 1
+        return j
 
     def set_bpm(self, bpm):
         """
         Set BPM. Beat timing assumes 4/4 time signature,
         e.g. 4 beats per measure, 1/4 note gets the beat
         """
-        beat_time = 60 / bpm  # time length of a single beat
-        beat_millis = beat_time * 1000  # time length of single beat in millis
-        # time length of a beat subdivision, e.g. 1/16th note
-        self.step_millis = int(beat_millis / self.steps_per_beat)
-        # and keep "step_millis" an int so diff math is fast
-        # FIXME: what about int round-down problem?
+        self.bpm = bpm
+        # time length of a beat subdivision (e.g. 1/16th note) is
+        # 60000 / (bpm * steps_per_beat) millis, which is rarely a whole number.
+        # Keep it as an exact fixed-point fraction in units of 1/step_denom millis.
+        # Steps are timed from a table of offsets from the start of the bar
+        # (see _step_table()), and the bar start is advanced by the exact bar
+        # length, carrying the fractional millis in "bar_phase", so the step
+        # clock never drifts. bpm is resolved to 1/100th of a beat.
+        self.step_denom = round(bpm * 100) * self.steps_per_beat
+        self.step_millis = (60_000 * 100) // self.step_denom  # whole millis per step
+        self.bar_phase = 0
+        self._retime()
+
+    def set_swing(self, swing):
+        """
+        Set swing of current pattern, as percent: 50 = straight,
+        66 = triplet feel, up to 75. Swing delays every other 16th note.
+        """
+        self.patterns[self.patt_index]['swing'] = swing
+        self._mark_dirty()
+        self._invalidate_step_tables(self.patt_index)
+
+    def set_microtiming(self, pos, offset):
+        """
+        Nudge step 'pos' of current pattern early or late by 'offset'
+        percent of a step, -50 to 50
+        """
+        patt = self.patterns[self.patt_index]
+        if 'micro' not in patt:
+            patt['micro'] = array('b', (0 for _ in range(len(self.sequence))))
+        patt['micro'][pos] = offset
+        self._mark_dirty()
+        self._invalidate_step_tables(self.patt_index)
+
+    def _invalidate_step_tables(self, patt_index):
+        self._step_tables = {k: v for k, v in self._step_tables.items() if k[0] != patt_index}
+        self._retime()
+
+    def _step_table(self, patt_index):
+        """
+        Return the table of step times for a pattern at current bpm,
+        millis from the start of the bar for each step, with swing and
+        microtiming baked in. Built lazily and cached per (pattern, step_denom),
+        since step_denom changes with both bpm and steps_per_beat.
+        Times are kept strictly increasing and inside the bar, so heavy swing
+        or microtiming can't put two steps on the same millisecond or out of order.
+        """
+        key = (patt_index, self.step_denom)
+        table = self._step_tables.get(key)
+        if table is not None:
+            return table
+        if len(self._step_tables) >= 16:  # don't let bpm twiddling eat the heap
+            self._step_tables = {}
+        patt = self.patterns[patt_index]
+        num_steps = len(patt['seq'])
+        step_len = 60_000 * 100 / self.step_denom  # exact millis per step
+        swing = patt.get('swing', 50)
+        micro = patt.get('micro')
+        swing_steps = max(1, self.steps_per_beat // 4)  # steps per 16th note
+        swing_delay = (swing - 50) / 50 * swing_steps * step_len
+        bar_millis = num_steps * 60_000 * 100 // self.step_denom
+        table = array('l', (0 for _ in range(num_steps)))
+        earliest = 0
+        for k in range(num_steps):
+            t = k * step_len
+            if (k // swing_steps) % 2:  # off-beat 16th
+                t += swing_delay
+            if micro:
+                t += micro[k] * step_len / 100
+            # at least 1 ms after the step before, leave 1 ms for each step after
+            t = min(max(round(t), earliest), bar_millis - (num_steps - k))
+            table[k] = t
+            earliest = t + 1
+        self._step_tables[key] = table
+        return table
+
+    def _retime(self):
+        """Pick up step table for current pattern & bpm, keeping the next step where it is"""
+        if self.sequence is None:
+            return
+        self.step_table = self._step_table(self.patt_index)
+        if self.next_patt_index is not None:  # bpm may have changed
+            self._next_step_table = self._step_table(self.next_patt_index)
+        self._set_bar_length()
+        pos = self.pos % len(self.sequence)
+        self.bar_start_millis = ticks_add( self.next_step_millis, -self.step_table[pos] )
+
+    def _set_bar_length(self):
+        # exact bar length, whole millis plus remainder in 1/step_denom units
+        bar_len = len(self.sequence) * 60_000 * 100
+        self.bar_millis = bar_len // self.step_denom
+        self.bar_rem = bar_len % self.step_denom
+
+    def millis_until_step(self):
+        """How long until the next step is due (less lead_millis), negative if it's overdue"""
+        return ticks_diff( self.next_step_millis, ticks_ms() ) - self.lead_millis
+
+    def reset_stats(self):
+        """Reset the update() wakeup and step lateness counters"""
+        self.num_updates = 0  # how many times update() was called
+        self.num_steps_played = 0  # how many of those calls played a step
+        self.step_late_total = 0  # sum of step_late, for an average
+        self.step_late_max = 0  # worst step_late
+
+    def _untrigger(self):
+        """Call trig_off() for any pads triggered on the last step"""
+        mask = self.triggered
+        i = 0
+        while mask:
+            if mask & 1:
+                self.trig_off(i, self.pos)
+            mask >>= 1
+            i += 1
+        self.triggered = 0
 
     def update(self):
+        self.num_updates += 1
         now = ticks_ms()
-        diff = ticks_diff( now, self.last_step_millis )
-        if diff < self.step_millis:
-            if diff > 2:
-                # untrigger any triggered pads
-                for i in range(self.num_pads):
-                    if self.triggered[i]:
-                        self.trig_off(i, self.pos)
-                        self.triggered[i] = False
+        late_millis = ticks_diff( now, self.next_step_millis ) + self.lead_millis
+        if late_millis < 0:  # not time yet
+            if self.triggered and ticks_diff( now, self.last_step_millis ) > 2:
+                self._untrigger()
+            self.prefill()
             return
-        self.last_step_millis = now
-
-        late_millis = ticks_diff( diff, self.step_millis )  # how much are we late
-        self.last_step_millis = ticks_add( now, -(late_millis//2) ) # attempt to make it up on next step
-
-        # play any sounds recorded for this step
+        if self.triggered:  # not called in between steps (deadline sleeping), untrigger now
+            self._untrigger()
+        self.step_late = late_millis
+        self.num_steps_played += 1
+        self.step_late_total += late_millis
+        if late_millis > self.step_late_max:
+            self.step_late_max = late_millis
+        self.last_step_millis = self.next_step_millis
+        self.step_deadline = self.next_step_millis
+
+        # play any sounds recorded for this step, from the lookahead queue
+        j = self._pop_lookahead()
+        mask = self._la_mask[j]
         if self.playing:
-            
-            # fixme: also turn off any
-            step_line = self.sequence[self.pos]
-            #self.step_cb( self.pos, step_line)
-            
-            # go through any pads, seeing which notes to trigger
-            for i in range(self.num_pads):
-                # play_drum(i, sequence[i][pos] ) # FIXME: what about note-off
-                if step_line[i]:
-                    self.trig_on(i, self.pos)
-                    self.triggered[i] = True
+            self.triggered |= mask
+            vels = j * self.num_pads
+            # only walk the set bits of this step's mask
+            i = 0
+            while mask:
+                if mask & 1:
+                    self.trig_on(i, self.pos, self._la_vel[vels + i])
+                mask >>= 1
+                i += 1
 
         self.pos = (self.pos + 1) % self.num_steps
+        self.tick += 1
+
+        # schedule the next step against the absolute timeline, not "now":
+        # one lookup in the step table, plus the exact bar length at the end of a bar
+        if self.pos == 0:
+            bar_millis = self.bar_millis
+            self.bar_phase += self.bar_rem
+            if self.bar_phase >= self.step_denom:
+                self.bar_phase -= self.step_denom
+                bar_millis += 1
+            self.bar_start_millis = ticks_add( self.bar_start_millis, bar_millis )
+            if self.next_patt_index is not None:
+                # switch to the queued pattern, everything was resolved ahead of time
+                self._set_pattern(self.next_patt_index)
+                self.step_table = self._next_step_table
+                self._set_bar_length()
+                self.next_patt_index = None
+        elif self.pos == self.num_steps - 1:
+            self._resolve_next_pattern()
+        self.next_step_millis = ticks_add( self.bar_start_millis, self.step_table[self.pos] )
+        if (late_millis - self.lead_millis >= self.step_millis or
+                ticks_diff( now, self.next_step_millis ) >= self.step_millis):
+            # a whole step late (long GC, flash write, pos changed, etc), restart
+            # the timeline from now instead of playing a burst of steps. Not just
+            # "next step already due", swing or microtiming can put it right after this one
+            self.bar_start_millis = ticks_add( now, self.step_millis - self.step_table[self.pos] )
+            self.next_step_millis = ticks_add( self.bar_start_millis, self.step_table[self.pos] )
+
+        self.prefill()  # triggers are out, get upcoming steps ready
 
     def at_step(self):
         # tempo indicator (leds.show() called by LED handler)
@@ -102,8 +496,8 @@ class DrumSequencer():
         #if pos == 0:   leds[key_TAP_TEMPO] = 0x3333FF # first beat indicator
 
     @classmethod
-    def load_patterns(cls, filepath):
-        return load_patterns(filepath)
+    def load_patterns(cls, filepath, packed=False):
+        return load_patterns(filepath, packed=packed)
 
 
 #------------------------------------------------------------------------
@@ -143,17 +537,67 @@ patterns = [
   },
 ]
 
+Optionally the in-memory sequence can be "packed", one int bitmask
+per time step (bit N = pad N), stored in a bytearray (up to 8 pads)
+or an array('H') (up to 16 pads), e.g.:
+
+patterns = [
+ { 'name': 'patt0',
+   'pads': 8,
+   'seq': bytearray(b'\\x01\\x00\\x04\\x00 ...'),  # one byte per time step
+ },
+]
+
+This uses a fraction of the RAM of the list-of-lists form, and
+the sequencer only needs to walk the set bits of each step.
+
+Patterns can also have an optional velocity lane, 'vel'. On disk (and in
+"drum_patterns.py") it looks like 'seq', one row per pad, with a hex digit
+0-f per step ('f' is full level, use it as the accent). Missing 'vel'
+means every hit is full level. In memory it's 4-bit velocities packed
+two to a byte in a bytearray, indexed by step*num_pads + pad
+(see make_velocity_lane()), e.g. 128 bytes for 32 steps x 8 pads.
+
+Patterns can also have optional per-track lengths and clock dividers
+for polymeter, e.g. 32 steps of kick against 12 steps of hat:
+  'lens': list of steps used by each track (default: all of them)
+  'divs': list of clock dividers for each track (default: 1, every step)
+
+Patterns can also have optional timing feel, in any form:
+  'swing': 50-75 percent, how late every other 16th note is (50 = straight)
+  'micro': list of per-step offsets, -50 to 50 percent of a step
+
 """
 
-def load_patterns(cls, filepath="/saved_patterns.json", load_demo=True):
+def load_patterns(filepath="/saved_patterns.json", load_demo=True, packed=False):
+    """
+    Load patterns from JSON file into in-memory sequence form.
+    The file is read one pattern at a time, so the whole file never
+    needs to fit in RAM, and a bad pattern is reported and skipped
+    instead of losing the whole bank. If no patterns could be loaded,
+    load the demo patterns (or a blank pattern if 'load_demo' is False).
+    Then any patterns in the save journal (see PatternSaver) are replayed on top.
+    """
     patts = []
     try:
-        with open(filepath,'r') as fp:
-            patts = json.load(fp)
-            for p in patts:
-                # convert str of '1010' to array 1,0,1,0, eliding whitespace, for all seq lines
-                p['seq'] = [int(c) for c in s.replace(' ','') for s in p['seq']]
-    except (OSError, ValueError) as error:  # maybe no file
+        try:
+            fp = open(filepath,'r')
+        except OSError as error:  # maybe a save was cut off before its rename
+            try:
+                fp = open(filepath + ".tmp",'r')
+            except OSError:
+                raise error
+        with fp:
+            for i, text in enumerate(iter_json_objects(fp)):
+                try:
+                    patt = make_pattern(json.loads(text), packed)
+                    if patts and (len(patt['seq']) != len(patts[0]['seq']) or
+                                  patt['pads'] != patts[0]['pads']):
+                        raise ValueError("size differs from first pattern")
+                    patts.append(patt)
+                except (ValueError, KeyError, TypeError, IndexError) as error:
+                    print("load_patterns: pattern", i, "skipped:", error)
+    except OSError as error:  # maybe no file
         print("load_patterns:",error)
 
     if len(patts) == 0: # no patterns
@@ -163,50 +607,330 @@ def load_patterns(cls, filepath="/saved_patterns.json", load_demo=True):
         else:
             pypatts = drum_patterns.patterns_blank
             print("no saved patterns, loading blank pattern")
-        patts = []
-        for p in drum_patterns.patterns_demo:
-            patts.append( {'name':p['name'], 'seq': make_sequence_from_pypattern(p) } )
-        return patts
-
+        for p in pypatts:
+            patts.append(make_pattern(p, packed))
 
-def make_sequence_from_pypattern(patt):
+    # replay any patterns saved to the journal since the bank was written
+    try:
+        with open(filepath + ".jnl",'r') as fp:
+            for line in fp:  # one record per line
+                if not line.strip():
+                    continue
+                try:
+                    p = json.loads(line)
+                    i = p['i']
+                    patt = make_pattern(p, packed)
+                    if i < len(patts):
+                        patts[i] = patt
+                    elif i == len(patts):
+                        patts.append(patt)
+                except (ValueError, KeyError, TypeError, IndexError) as error:
+                    print("load_patterns: journal record skipped:", error)
+    except OSError:  # no journal, that's fine
+        pass
+    return patts
+
+
+def iter_json_objects(fp, chunk_size=512):
+    """
+    Yield the text of each top-level {...} object in a JSON array from
+    file 'fp', one at a time, reading the file in small chunks
+    """
+    depth = 0
+    in_str = False
+    escaped = False
+    parts = []  # pieces of the current object, if it spans chunks
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        start = 0
+        for i in range(len(chunk)):
+            c = chunk[i]
+            if in_str:
+                if escaped:
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                elif c == '"':
+                    in_str = False
+            elif c == '"':
+                in_str = True
+            elif c == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif c == '}' and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    parts.append(chunk[start:i+1])
+                    yield ''.join(parts)
+                    parts = []
+        if depth > 0:
+            parts.append(chunk[start:])
+
+
+def make_pattern(patt, packed=False):
+    """
+    Turn a pattern as stored on disk or in "drum_patterns.py"
+    into its in-memory form
+    """
+    num_pads = len(patt['seq'])
+    seq = make_sequence_from_pypattern(patt, packed)
+    num_steps = len(seq)
+    p = {'name': patt['name'], 'pads': num_pads, 'seq': seq}
+    if 'vel' in patt:
+        p['vel'] = make_velocity_lane(num_steps, num_pads, patt['vel'])
+    for key in ('lens', 'divs'):  # one per pad, 1 to num_steps
+        if key in patt:
+            vals = patt[key]
+            if len(vals) != num_pads:
+                raise ValueError("%s has %d entries, not %d" % (key, len(vals), num_pads))
+            for v in vals:
+                if not 1 <= v <= num_steps:
+                    raise ValueError("bad %s value %r" % (key, v))
+            p[key] = bytearray(vals)
+    if 'swing' in patt:
+        p['swing'] = int(patt['swing'])
+    if 'micro' in patt:
+        p['micro'] = array('b', patt['micro'])
+    return p
+
+
+def make_sequence_from_pypattern(patt, packed=False):
     """
     Turn a python pattern (e.g. stored in "drum_patterns.py") to an internal sequence list
+    If 'packed' is True, return packed form of one bitmask per step instead
     """
     # get length of pattern and num pads from pattern string rep
-    num_steps = len(patt['seq'][0].replace(' ',''))
-    num_pads = len(patt['seq'])
-    seq = []
-    # first convert '1010...' step strings to 1,0,1,0 numeric array
-    for stepline_str in patt['seq']:
-        stepline = [int(c) for c in stepline_str.replace(' ','')]
-        seq.append(stepline)
+    rows = patt['seq']
+    num_steps = len(rows[0]) - rows[0].count(' ')
+    num_pads = len(rows)
+    if packed:
+        seq = make_packed_steps(num_steps, num_pads)
+    else:
+        seq = [[0] * num_pads for _ in range(num_steps)]
+    # walk each '1010...' pad row, skipping whitespace, straight into the step list
+    for pad, row in enumerate(rows):
+        step = 0
+        for c in row:
+            if c == ' ':
+                continue
+            if step == num_steps:
+                raise ValueError("row %d too long" % pad)
+            if c == '1':
+                if packed:
+                    seq[step] |= (1 << pad)
+                else:
+                    seq[step][pad] = 1
+            elif c != '0':
+                raise ValueError("bad step %r in row %d" % (c, pad))
+            step += 1
+        if step != num_steps:
+            raise ValueError("row %d too short" % pad)
+    return seq
+
+
+def make_velocity_lane(num_steps, num_pads=8, rows=None):
+    """
+    Make a velocity lane, 4-bit velocities (0-15) packed two per byte,
+    all full (15) or from 'rows' of hex digit strings, one row per pad
+    """
+    vel = bytearray(b'\xff' * ((num_steps * num_pads + 1) // 2))
+    if rows:
+        for pad, row in enumerate(rows):
+            step = 0
+            for c in row:
+                if c == ' ':
+                    continue
+                set_velocity(vel, num_pads, step, pad, int(c, 16))
+                step += 1
+    return vel
+
+
+def get_velocity(vel, num_pads, step, pad):
+    """Return velocity of pad at step from velocity lane"""
+    n = step * num_pads + pad
+    return (vel[n >> 1] >> ((n & 1) << 2)) & 0x0F
+
+
+def set_velocity(vel, num_pads, step, pad, v):
+    """Set velocity of pad at step in velocity lane"""
+    n = step * num_pads + pad
+    shift = (n & 1) << 2
+    vel[n >> 1] = (vel[n >> 1] & ~(0x0F << shift)) | ((v & 0x0F) << shift)
+
+
+def make_packed_steps(num_steps, num_pads=8):
+    """
+    Make an empty packed sequence: a bytearray for up to 8 pads,
+    or an array('H') for up to 16 pads, one bitmask per step
+    """
+    if num_pads <= 8:
+        return bytearray(num_steps)
+    return array('H', (0 for _ in range(num_steps)))
 
-    # now transpose the matrix to make it a list of trigs in a list of steps
-    seqt = []
-    for i in range(num_steps):
-        seqt.append( [seq[j][i] for j in range(num_pads)] )
-    return seqt
+
+def pack_sequence(seq):
+    """
+    Turn a list-of-lists sequence into packed form, one bitmask per step
+    """
+    num_pads = len(seq[0])
+    packed = make_packed_steps(len(seq), num_pads)
+    for i, step_line in enumerate(seq):
+        mask = 0
+        for j in range(num_pads):
+            if step_line[j]:
+                mask |= (1 << j)
+        packed[i] = mask
+    return packed
 
 
 ####################################
 
-last_write_time = 0 #time.monotonic()
-def save_patterns(patterns):
-    global last_write_time
+def pattern_to_json(patt):
+    """
+    Turn an in-memory pattern (either form) back into its on-disk form,
+    one '1010...' row per pad, plus any velocity/polymeter/feel extras
+    """
+    seq = patt['seq']
+    packed = not isinstance(seq[0], list)
+    num_pads = patt.get('pads', 8) if packed else len(seq[0])
+    rows = []
+    for pad in range(num_pads):
+        if packed:
+            rows.append(''.join('1' if (m >> pad) & 1 else '0' for m in seq))
+        else:
+            rows.append(''.join('1' if l[pad] else '0' for l in seq))
+    p = {'name': patt['name'], 'seq': rows}
+    if 'vel' in patt:
+        vel = patt['vel']
+        p['vel'] = [''.join('%x' % get_velocity(vel, num_pads, step, pad)
+                            for step in range(len(seq))) for pad in range(num_pads)]
+    for key in ('lens', 'divs', 'micro'):
+        if key in patt:
+            p[key] = list(patt[key])
+    if 'swing' in patt:
+        p['swing'] = patt['swing']
+    return p
+
+
+def save_patterns(patterns, filepath="/saved_patterns.json"):
+    """
+    Write all patterns to JSON file. The file is written to a temp file
+    then renamed, so a power cut mid-write never leaves a half-written bank
+    (load_patterns() picks up the temp file if the rename didn't happen)
+    """
     print("saving patterns...", end='')
-    #if ticks_ms() - last_write_time < 10: # only allow writes every 10 seconds, to save flash
-    #    print("NO WRITE: TOO SOON")
-    #    return
-    #last_write_time = time.monotonic()
-    patts_to_sav = []
-    for p in patterns:
-        seq_to_sav = [''.join(str(c) for c in l) for l in p['seq']]
-        patts_to_sav.append( {'name': p['name'], 'seq': seq_to_sav } )
-    with open('/test_saved_patterns.json', 'w') as fp:
-    #with sys.stdout as fp:
-        json.dump(patts_to_sav, fp)
-    print("\ndone")
+    tmppath = filepath + ".tmp"
+    with open(tmppath, 'w') as fp:
+        fp.write('[\n')
+        for i, p in enumerate(patterns):
+            if i:
+                fp.write(',\n')
+            json.dump(pattern_to_json(p), fp)  # one at a time, not the whole bank
+        fp.write('\n]\n')
+    try:
+        os.remove(filepath)  # FAT can't rename over an existing file
+    except OSError:
+        pass
+    os.rename(tmppath, filepath)
+    print("done")
+
+
+def append_journal(patterns, indexes, filepath="/saved_patterns.json"):
+    """
+    Append just the given patterns to the journal next to the JSON file,
+    one line each, replayed over the bank by load_patterns().
+    Each record starts a new line, so a line torn by a power cut
+    is skipped on load without taking the next record with it.
+    """
+    with open(filepath + ".jnl", 'a') as fp:
+        for i in indexes:
+            p = pattern_to_json(patterns[i])
+            p['i'] = i
+            fp.write('\n')
+            json.dump(p, fp)
+
+
+class PatternSaver:
+    """
+    Save edited patterns in the background, gently on the flash:
+    - only patterns the sequencer marked dirty are written, appended to a journal
+    - writes are rate-limited and wait for edits to settle
+    - writes only happen right after a step, never near a step boundary
+    - the journal is compacted into the JSON file when the sequencer is stopped
+    - on a read-only filesystem it says so once and stops trying
+    Call update() regularly, e.g. from an asyncio task.
+    """
+    def __init__(self, seq, filepath="/saved_patterns.json", min_interval_millis=10_000,
+                 settle_millis=2000, write_window_millis=30, compact_after=8):
+        self.seq = seq
+        self.filepath = filepath
+        self.min_interval_millis = min_interval_millis  # at most one write this often
+        self.settle_millis = settle_millis  # wait this long after last edit
+        self.write_window_millis = write_window_millis  # need this long until next step
+        self.compact_after = compact_after  # compact once journal has this many records
+        self.last_write_millis = ticks_add(ticks_ms(), -min_interval_millis)
+        self.journal_len = 0  # records in journal since last compaction
+        try:
+            with open(filepath + ".jnl") as fp:
+                for line in fp:
+                    if line.strip():
+                        self.journal_len += 1
+        except OSError:
+            pass
+        self.num_writes = 0
+        self.read_only = False  # set when the filesystem turns out to be read-only
+
+    def _write_failed(self, error, now):
+        if error.errno == 30:  # EROFS, CIRCUITPY not remounted writable by boot.py
+            print("PatternSaver: filesystem is read-only, not saving patterns")
+            self.read_only = True
+        else:  # try again later
+            print("PatternSaver:", error)
+        self.last_write_millis = now
+
+    def _safe_to_write(self, window_millis):
+        """True if the next step isn't due for a while"""
+        return self.seq.millis_until_step() >= window_millis
+
+    def update(self):
+        """Save dirty patterns or compact the journal if it's time. Returns True if it wrote"""
+        if self.read_only:
+            return False
+        seq = self.seq
+        now = ticks_ms()
+        if ticks_diff(now, self.last_write_millis) < self.min_interval_millis:
+            return False
+        dirty = [i for i in range(seq.num_patterns) if seq.dirty[i]]
+        if dirty:
+            if ticks_diff(now, seq.last_edit_millis) < self.settle_millis:
+                return False
+            if not self._safe_to_write(self.write_window_millis):
+                return False
+            try:
+                append_journal(seq.patterns, dirty, self.filepath)
+            except OSError as error:  # e.g. read-only filesystem
+                self._write_failed(error, now)
+                return False
+            for i in dirty:
+                seq.dirty[i] = 0
+            self.journal_len += len(dirty)
+        elif self.journal_len >= self.compact_after and not seq.playing:
+            # whole-file write, only when stopped so timing doesn't matter
+            try:
+                save_patterns(seq.patterns, self.filepath)
+                os.remove(self.filepath + ".jnl")
+            except OSError as error:
+                self._write_failed(error, now)
+                return False
+            self.journal_len = 0
+        else:
+            return False
+        self.last_write_millis = now
+        self.num_writes += 1
+        return True
 
 
 def copy_pattern(patt_index):
@@ -0,0 +1,78 @@
+
+#
+# Drum voice allocation
+#
+from array import array
+from adafruit_ticks import ticks_ms, ticks_diff
+
+FREE = 255  # voice_pad value of a voice not playing a pad
+
+class VoiceAllocator:
+    """
+    Hands out audiomixer.Mixer voices to drum pads, instead of pad N always
+    playing on mixer.voice[N].
+    - the first 'reserved' voices are left alone, e.g. mixer.voice[0] plays the synth
+    - a pad retriggering cuts itself off, like before
+    - pads in the same choke group cut each other off, e.g. closed hat cuts open hat
+    - if all voices are busy, the quietest voice is stolen, the oldest of those if a tie
+    All per-voice state is in preallocated arrays so play() doesn't allocate.
+    """
+    def __init__(self, mixer, num_pads=8, reserved=1, choke_groups=()):
+        self.voices = mixer.voice
+        self.num_voices = len(mixer.voice)
+        self.first_voice = reserved
+        self.voice_pad = bytearray(b'\xff' * self.num_voices)  # pad playing on each voice
+        self.voice_vel = bytearray(self.num_voices)  # velocity each voice was started with
+        self.voice_start = array('l', [0] * self.num_voices)  # ticks_ms each voice was started
+        self.pad_voice = bytearray(b'\xff' * num_pads)  # voice each pad last played on
+        self.pad_choke = bytearray(num_pads)  # choke group of each pad, 0 = none
+        for g, pads in enumerate(choke_groups):
+            for p in pads:
+                self.pad_choke[p] = g + 1
+        self.num_steals = 0
+
+    def set_mixer(self, mixer):
+        """Use the voices of a new mixer, e.g. after DrumCardHardware.set_latency()"""
+        self.voices = mixer.voice
+        for v in range(self.num_voices):
+            self.voice_pad[v] = FREE
+
+    def play(self, pad, sample, level=1.0, vel=15):
+        """Play a sample for a pad at a mixer level, return the voice number used"""
+        group = self.pad_choke[pad]
+        if group:
+            for v in range(self.first_voice, self.num_voices):
+                p = self.voice_pad[v]
+                if p != FREE and p != pad and self.pad_choke[p] == group:
+                    self.voices[v].stop()
+                    self.voice_pad[v] = FREE
+        v = self.pad_voice[pad]
+        if v == FREE or self.voice_pad[v] != pad:  # pad's voice went to another pad
+            v = self.find_voice()
+        voice = self.voices[v]
+        voice.level = level
+        voice.play(sample, loop=False)
+        self.voice_pad[v] = pad
+        self.voice_vel[v] = vel
+        self.voice_start[v] = ticks_ms()
+        self.pad_voice[pad] = v
+        return v
+
+    def find_voice(self):
+        """Return a free voice, or the one to steal if none are free"""
+        steal = FREE
+        for v in range(self.first_voice, self.num_voices):
+            if self.voice_pad[v] == FREE or not self.voices[v].playing:
+                return v
+            if (steal == FREE or self.voice_vel[v] < self.voice_vel[steal] or
+                (self.voice_vel[v] == self.voice_vel[steal] and
+                 ticks_diff(self.voice_start[v], self.voice_start[steal]) < 0)):
+                steal = v
+        self.num_steals += 1
+        return steal
+
+    def stop_all(self):
+        """Stop all the drum voices, leaving the reserved ones alone"""
+        for v in range(self.first_voice, self.num_voices):
+            self.voices[v].stop()
+            self.voice_pad[v] = FREE
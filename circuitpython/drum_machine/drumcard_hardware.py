@@ -8,8 +8,10 @@ import audiopwmio, audiomixer, audiocore, synthio
 import usb_midi
 import ulab.numpy as np
 
+from adafruit_ticks import ticks_ms
 import tmidi
 import ts20
+from audio_latency import latency_profiles, latency_millis
 
 i2c_sda_pin = board.GP16
 i2c_scl_pin = board.GP17
@@ -53,6 +55,10 @@ pad_to_led = (
 )
 # fmt: on
 
+# touch mask bit-permutation for the low byte: swap pads 1-4 with pads 5-8
+# to match layout weirdness
+touch_swizzle = bytes(((i & 0x0F) << 4) | (i >> 4) for i in range(256))
+
 
 class DrumCardHardware:
 
@@ -79,11 +85,15 @@ class DrumCardHardware:
     PAD_B = 15
     PAD_SHIFT = 16
 
-    def __init__(self, sample_rate=22050, num_voices=8):
+    def __init__(self, sample_rate=22050, num_voices=8, latency='safe'):
         self.sample_rate = sample_rate
         self.num_voices = num_voices
+        self.latency = latency  # name of audio_latency.latency_profiles entry in use
+        self.synth = None
+        self.audio_start_millis = 0  # ticks_ms when audio output last started, for audio_clock
+        self.touch_mask = 0
         i2c = busio.I2C(scl=i2c_scl_pin, sda=i2c_sda_pin, frequency=400_000)
-        self.ts20 = ts20.TS20(i2c)
+        self.ts20 = ts20.TS20(i2c, only_changed=True)  # skip config if already set, e.g. soft reload
 
         self.uart = busio.UART(tx=midi_out_pin, rx=midi_in_pin, baudrate=31250, timeout=0.0001)
         self.midi_usb = tmidi.MIDI(midi_in=usb_midi.ports[0], midi_out=usb_midi.ports[1])
@@ -91,9 +101,7 @@ class DrumCardHardware:
 
         # set up the synth->audio system
         self.audio = audiopwmio.PWMAudioOut(audio_pin)
-        self.mixer = audiomixer.Mixer(voice_count=num_voices, sample_rate=sample_rate,
-                                      channel_count=1, bits_per_sample=16, samples_signed=True,
-                                      buffer_size=2048) 
+        self.mixer = self.make_mixer()
         self.leds = []
         for pin in led_pins:
             print("pin:", pin)
@@ -101,9 +109,37 @@ class DrumCardHardware:
             led.switch_to_output(value=False)
             self.leds.append(led)
 
+    def make_mixer(self):
+        return audiomixer.Mixer(voice_count=self.num_voices, sample_rate=self.sample_rate,
+                                channel_count=1, bits_per_sample=16, samples_signed=True,
+                                buffer_size=latency_profiles[self.latency])
+
+    def set_latency(self, latency):
+        """
+        Change to a different audio_latency.latency_profiles buffer size, by making a new mixer.
+        Returns True if it changed, then any voices of the old mixer need replacing.
+        """
+        if latency == self.latency:
+            return False
+        self.latency = latency
+        self.audio.stop()
+        self.mixer = self.make_mixer()
+        if self.synth:
+            self.mixer.voice[0].level = self.synth_level
+            self.mixer.voice[0].play(self.synth)
+        self.audio.play(self.mixer)
+        self.audio_start_millis = ticks_ms()
+        return True
+
+    def latency_millis(self):
+        """Worst case millis from starting a mixer voice to hearing it"""
+        return latency_millis(latency_profiles[self.latency], self.sample_rate)
+
     def start_synth(self, level=0.75):
         self.synth = synthio.Synthesizer(sample_rate=self.sample_rate)
+        self.synth_level = level
         self.audio.play(self.mixer)
+        self.audio_start_millis = ticks_ms()
         self.mixer.voice[0].level = level # turn down the volume a bit since this can get loud
         self.mixer.voice[0].play(self.synth)
         
@@ -132,15 +168,19 @@ class DrumCardHardware:
     def pad_to_led(self, i):
         return pad_to_led[i]
 
-    def read_touch(self):
-        touches = self.ts20.read_touches()
-        # swizzle first four and second four to match layout weirdness I did
-        touches[0:4], touches[4:8] = touches[4:8],touches[0:4]
-        self.touches = touches
-        return self.touches
+    def read_touch_mask(self):
+        """Read touches as an int bitmask, bit N set if padid N is touched. Doesn't allocate."""
+        t = self.ts20.read_touch_mask()
+        t = (t & ~0xFF) | touch_swizzle[t & 0xFF]
+        self.touch_mask = t
+        return t
+
+    def pad_to_channel(self, i):
+        """TS20 channel (0-19) of a padid, undoing the read_touch_mask() swizzle"""
+        return i ^ 4 if i < 8 else i
 
     def update(self):
-        self.read_touches()
+        self.read_touch_mask()
 
     def startup_demo(self, n=2, t=0.02):
         print("picotouch_drumcard: startup demo")
@@ -155,13 +195,3 @@ class DrumCardHardware:
                 self.set_led(demo_led_map[i], False)
                 self.synth.release(note)
                 time.sleep(t)
-
-    def bad_touch(self):
-        ts = self.touches
-        return (
-            (ts.count(1) > 2) or
-            (ts[20]) or
-            ((ts[7] and ts[8] and ts[9]) or
-             (ts[9] and ts[10] and ts[11]) or
-             (ts[10] and ts[11] and ts[12]))
-        )
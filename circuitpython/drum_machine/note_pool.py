@@ -0,0 +1,84 @@
+
+#
+# Preallocated synthio notes for MIDI input
+#
+import synthio
+
+FREE = 255  # no note / no slot
+
+class NotePool:
+    """
+    Plays MIDI notes on a synthio.Synthesizer using a fixed pool of
+    synthio.Note objects, made upfront, so handling a MIDI message doesn't
+    allocate (and so doesn't cause gc pauses that throw off the sequencer).
+    - each held MIDI note number is mapped to one of 'max_voices' notes
+    - velocity sets note amplitude, through a precomputed table
+    - pressing more than 'max_voices' notes steals the oldest held note
+    """
+    def __init__(self, synth, max_voices=8, waveform=None):
+        self.synth = synth
+        self.max_voices = max_voices
+        self.notes = [synthio.Note(frequency=440, waveform=waveform) for _ in range(max_voices)]
+        self.note_hz = tuple(synthio.midi_to_hz(n) for n in range(128))
+        # velocity to amplitude, squared for a more even loudness curve
+        self.vel_to_amp = tuple((v / 127) ** 2 for v in range(128))
+        self.slot_note = bytearray(b'\xff' * max_voices)  # MIDI note number held in each slot
+        self.note_slot = bytearray(b'\xff' * 128)  # slot each MIDI note number is held in
+        self.order = bytearray(max_voices)  # held slots, oldest first
+        self.num_held = 0
+        self.next_slot = 0  # where to start looking for a free slot
+        self.num_steals = 0
+
+    def press(self, notenum, vel=127):
+        if vel == 0:  # MIDI note on with zero velocity is note off
+            self.release(notenum)
+            return
+        slot = self.note_slot[notenum]
+        if slot != FREE:  # already held, retrigger it
+            self._unhold(slot)
+        elif self.num_held < self.max_voices:
+            slot = self.next_slot
+            while self.slot_note[slot] != FREE:
+                slot = (slot + 1) % self.max_voices
+            # round-robin, so a just-released note gets to finish its release
+            self.next_slot = (slot + 1) % self.max_voices
+        else:  # steal oldest
+            slot = self.order[0]
+            self._unhold(slot)
+            self.note_slot[self.slot_note[slot]] = FREE
+            self.num_steals += 1
+        note = self.notes[slot]
+        note.frequency = self.note_hz[notenum]
+        note.amplitude = self.vel_to_amp[vel]
+        self.slot_note[slot] = notenum
+        self.note_slot[notenum] = slot
+        self.order[self.num_held] = slot
+        self.num_held += 1
+        self.synth.press(note)
+
+    def release(self, notenum):
+        slot = self.note_slot[notenum]
+        if slot == FREE:  # not held, or was stolen
+            return
+        self.synth.release(self.notes[slot])
+        self._unhold(slot)
+        self.note_slot[notenum] = FREE
+        self.slot_note[slot] = FREE
+
+    def release_all(self):
+        for n in range(self.num_held):
+            slot = self.order[n]
+            self.synth.release(self.notes[slot])
+            self.note_slot[self.slot_note[slot]] = FREE
+            self.slot_note[slot] = FREE
+        self.num_held = 0
+
+    def _unhold(self, slot):
+        """Take a slot out of the held order, keeping the rest in order"""
+        i = 0
+        while self.order[i] != slot:
+            i += 1
+        self.num_held -= 1
+        while i < self.num_held:
+            self.order[i] = self.order[i + 1]
+            i += 1
@@ -0,0 +1,82 @@
+
+#
+# Velocity-sensitive pads, from how fast a pad's raw capacitance changes when hit
+#
+from array import array
+from adafruit_ticks import ticks_ms, ticks_diff
+
+class PadVelocity:
+    """
+    Guesses how hard a pad was hit from its TS20 raw channel data right after
+    its touch edge: a fast hit moves the sensing value away from reference
+    faster than a slow press.
+    Doesn't block: start() a pad's measurement when it's touched, then call
+    update() about every millisecond until it says the pad is done, so touch
+    scanning and the other tasks keep running in between. Pads hit together
+    are measured together, update() only reads the channels of pads in progress.
+    A pad's channel is read on the first update() after start(), and again
+    once 'window_millis' have passed. From a task sleeping 1 ms both reads
+    land right after a millisecond tick, so the measured time is close to
+    exact, and the change over it divided by the time is the rate of change.
+    It's measured in 1/1000ths of the channel's reference per millisecond,
+    so pads of different sizes compare, and 'full_rate' of it is velocity 15.
+    """
+    def __init__(self, ts20, num_pads=8, window_millis=4, full_rate=10, min_vel=2):
+        self.ts20 = ts20
+        self.window_millis = max(window_millis, 1)
+        self.full_rate = full_rate
+        self.min_vel = min_vel  # softest velocity, so a light touch is still heard
+        self.last_rate = 0  # for tuning full_rate
+        self.pending = 0  # bitmask of pads started but not read yet
+        self.measuring = 0  # bitmask of pads read once, waiting for the window to pass
+        self.channels = bytearray(num_pads)  # TS20 channel of each pad
+        self.first = array('l', [0] * num_pads)  # first raw read of each pad
+        self.first_millis = array('l', [0] * num_pads)  # when it was read
+        self.touch_millis = array('l', [0] * num_pads)  # when each pad was touched
+        self.vels = bytearray(num_pads)  # velocity 0-15 of each pad done
+
+    def busy(self):
+        """True if any pad is being measured"""
+        return (self.pending | self.measuring) != 0
+
+    def start(self, pad, channel, now):
+        """Start measuring a hit on 'pad', TS20 'channel' (0-19), touched at 'now'"""
+        self.channels[pad] = channel
+        self.touch_millis[pad] = now
+        self.pending |= 1 << pad
+        self.measuring &= ~(1 << pad)  # hit again before it was done, start over
+
+    def update(self):
+        """Read the pads being measured, return bitmask of pads done, their velocity in 'vels'"""
+        ts20 = self.ts20
+        now = ticks_ms()
+        done = 0
+        busy = self.pending | self.measuring
+        pad = 0
+        while busy:
+            if busy & 1:
+                bit = 1 << pad
+                if self.pending & bit:
+                    self.first[pad] = ts20.read_raw(self.channels[pad])
+                    self.first_millis[pad] = now
+                    self.pending &= ~bit
+                    self.measuring |= bit
+                else:
+                    elapsed = ticks_diff(now, self.first_millis[pad])
+                    if elapsed >= self.window_millis:
+                        change = ts20.read_raw(self.channels[pad]) - self.first[pad]
+                        self.vels[pad] = self.velocity(change, ts20.raw_ref, elapsed)
+                        self.measuring &= ~bit
+                        done |= bit
+            busy >>= 1
+            pad += 1
+        return done
+
+    def velocity(self, change, ref, elapsed):
+        """Return velocity 0-15 of a raw 'change' over 'elapsed' millis on a channel with 'ref'"""
+        if ref == 0:
+            return 15
+        rate = abs(change) * 1000 // (ref * elapsed)
+        self.last_rate = rate
+        vel = rate * 15 // self.full_rate
+        return max(self.min_vel, min(vel, 15))
@@ -0,0 +1,69 @@
+
+#
+# Queue of touch pad press/release edges, for scanning fast and handling slow
+#
+from array import array
+
+class TouchEvents:
+    """
+    Ring buffer of timestamped touch edges, found by comparing touch masks
+    from DrumCardHardware.read_touch_mask(). A fast scanning task pushes
+    edges in with scan(), any number of TouchEventReaders take them out
+    at their own pace. When full, the oldest events are overwritten.
+    Events are in preallocated arrays so scanning doesn't allocate:
+    - 'pads[slot]' : padid
+    - 'pressed[slot]' : 1 if pressed, 0 if released
+    - 'times[slot]' : ticks_ms of the scan that saw it
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self.pads = bytearray(size)
+        self.pressed = bytearray(size)
+        self.times = array('l', [0] * size)
+        self.count = 0  # events pushed so far, next one goes in slot count % size
+        self.last_mask = 0
+
+    def push(self, pad, pressed, now):
+        slot = self.count % self.size
+        self.pads[slot] = pad
+        self.pressed[slot] = pressed
+        self.times[slot] = now
+        self.count += 1
+
+    def scan(self, mask, now):
+        """Push an event for each pad that changed since the last mask, return how many"""
+        changed = mask ^ self.last_mask
+        self.last_mask = mask
+        n = 0
+        i = 0
+        while changed:
+            if changed & 1:
+                self.push(i, (mask >> i) & 1, now)
+                n += 1
+            changed >>= 1
+            i += 1
+        return n
+
+    def reader(self):
+        return TouchEventReader(self)
+
+
+class TouchEventReader:
+    """Reads events from a TouchEvents, starting from the next one pushed"""
+    def __init__(self, events):
+        self.events = events
+        self.pos = events.count  # event number of the next one to read
+        self.num_dropped = 0  # events overwritten before they were read
+
+    def read(self):
+        """Return ring slot of the next unread event, or -1 if there isn't one"""
+        events = self.events
+        behind = events.count - self.pos
+        if behind == 0:
+            return -1
+        if behind > events.size:  # fell too far behind, skip to the oldest one still there
+            self.num_dropped += behind - events.size
+            self.pos = events.count - events.size
+        slot = self.pos % events.size
+        self.pos += 1
+        return slot
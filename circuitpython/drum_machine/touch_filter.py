@@ -0,0 +1,88 @@
+
+#
+# Ghost touch filtering on touch masks from DrumCardHardware.read_touch_mask()
+#
+
+TOUCH_NOISY = 1 << 20  # TS20 "isnoisy" bit of a touch mask
+TOUCH_CHANNELS = TOUCH_NOISY - 1  # the 20 touch channels
+
+# pads next to each other that light up together when it's a ghost touch
+ghost_triples = (0b111 << 7, 0b111 << 9, 0b111 << 10)
+
+# number of bits set in a byte
+popcount8 = bytes(bin(i).count('1') for i in range(256))
+
+def popcount(m):
+    """Number of bits set in a touch mask"""
+    return popcount8[m & 0xFF] + popcount8[(m >> 8) & 0xFF] + popcount8[(m >> 16) & 0xFF]
+
+class TouchFilter:
+    """
+    Masks out touches that can't be real instead of throwing away the whole
+    scan, so a real hit on one pad isn't lost because of a ghost on another:
+    - all three pads of a ghost triple newly touched together
+    - more than 'max_new' pads newly touched in the same scan, not counting ghosts
+    - anything newly touched while the TS20 says it's noisy (bit 20),
+      during which pads already touched stay touched
+    Channels that get masked out stay suspect for 'suspect_scans' scans,
+    in which they have to be touched two scans in a row to count.
+    Pads already touched are never masked out, so they release normally.
+    """
+    def __init__(self, max_new=2, suspect_scans=8, num_channels=20):
+        self.max_new = max_new
+        self.suspect_scans = suspect_scans
+        self.num_channels = num_channels
+        self.mask = 0  # last filtered mask
+        self.last_raw = 0  # last mask given to update()
+        self.suspect = 0  # channels masked out recently
+        self.suspect_left = bytearray(num_channels)  # scans each channel stays suspect
+        self.num_rejected = 0  # touches masked out
+
+    def update(self, raw):
+        """Return touch mask 'raw' with touches that can't be real masked out"""
+        new = raw & ~self.mask & TOUCH_CHANNELS
+        bad = 0
+        if new:
+            if raw & TOUCH_NOISY:
+                bad = new
+            else:
+                for g in ghost_triples:
+                    if raw & g == g:
+                        bad |= g & new
+                rest = new & ~bad  # only count touches that aren't ghosts
+                if popcount(rest) > self.max_new:
+                    bad |= rest
+                else:
+                    bad |= rest & self.suspect & ~self.last_raw  # suspect, not touched last scan
+        if self.suspect:
+            self._age_suspects()
+        if bad:
+            self._mark_suspect(bad)
+        if raw & TOUCH_NOISY:  # hold on to what's touched, releases could be noise too
+            mask = self.mask
+        else:
+            mask = (raw & self.mask) | (new & ~bad)
+        self.last_raw = raw
+        self.mask = mask
+        return mask
+
+    def _mark_suspect(self, bad):
+        self.suspect |= bad
+        ch = 0
+        while bad:
+            if bad & 1:
+                self.suspect_left[ch] = self.suspect_scans
+                self.num_rejected += 1
+            bad >>= 1
+            ch += 1
+
+    def _age_suspects(self):
+        s = self.suspect
+        ch = 0
+        while s:
+            if s & 1:
+                self.suspect_left[ch] -= 1
+                if self.suspect_left[ch] == 0:
+                    self.suspect &= ~(1 << ch)
+            s >>= 1
+            ch += 1
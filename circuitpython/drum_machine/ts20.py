@@ -6,6 +6,8 @@
 # Configuration information from:
 #   https://github.com/yni2yni/TS20
 
+import time
+from array import array
 from micropython import const
 from adafruit_bus_device import i2c_device
 
@@ -70,18 +72,13 @@ PADSENS2 = const((PADSENS << 4) | PADSENS)
 
 # fmt: off
 # default config for 20 touch sensors with low-impedance, low-sensitivity
+# in register address order, so TS20.write_config() can send it as
+# three block writes instead of one write per register
 _config_info_default = [
     # register name, register data
     # RB_SEL=Noram, Sleep Mode=Disable, S/W Reset=Enable,
     # IMP_SEL=High Imp. S/M_Mode=Multi, VPM=0
     (_TS20_GTRL2, 0x1A), # put chip into reset, so we can change parameters?
-    # set all ports to capsense (as opposed to LED driver or tact switch)
-    (_TS20_PORT_CTRL1, 0x00),  # Port Control
-    (_TS20_PORT_CTRL2, 0x00),
-    (_TS20_PORT_CTRL3, 0x00),
-    (_TS20_PORT_CTRL4, 0x00),
-    (_TS20_PORT_CTRL5, 0x00),
-    (_TS20_PORT_CTRL6, 0x00),
     # Sensitivty
     # if SSC bit =1(Normal Step) , (Data Value x 0.2%)+0.15%
     # if SSC bit =0(Fine Stemp) , (Data Value x 0.1%)+0.05%
@@ -102,14 +99,21 @@ _config_info_default = [
     #(_TS20_GTRL1, 0x4a), # reset default
     #(_TS20_GTRL1, 0x48), # gives a snappier response!
     (_TS20_GTRL1, 0x6a), # MS=1 "fast mode", SSC=1 normal steps
-    
+    (_TS20_GTRL2, 0x1A), # still in reset, here so the block doesn't break
+    #(_TS20_CAL_CTRL, 0xFA),
+    (_TS20_CAL_CTRL, 0xAF),
+    # set all ports to capsense (as opposed to LED driver or tact switch)
+    (_TS20_PORT_CTRL1, 0x00),  # Port Control
+    (_TS20_PORT_CTRL2, 0x00),
+    (_TS20_PORT_CTRL3, 0x00),
+    (_TS20_PORT_CTRL4, 0x00),
+    (_TS20_PORT_CTRL5, 0x00),
+    (_TS20_PORT_CTRL6, 0x00),
     (_TS20_CAL_HOLD1, 0x00),  # Calibration On, ch 1-7
     (_TS20_CAL_HOLD2, 0x00),  # Calibration On, ch 8-14
-    (_TS20_CAL_HOLD2, 0x00),  # Calibration On, ch 9-20
+    (_TS20_CAL_HOLD3, 0x00),  # Calibration On, ch 15-20
     #(_TS20_ERR_CTRL, 0x0D),
     (_TS20_ERR_CTRL, 0x0F),
-    #(_TS20_CAL_CTRL, 0xFA),
-    (_TS20_CAL_CTRL, 0xAF),
     # General Ctrl2, RB_SEL=Noram, Sleep Mode=Disable, S/W Reset=Disable,
     #                IMP_SEL=High Imp. S/M_Mode=Multi, VPM=0
     #(_TS20_GTRL2, 0x12),     # Software Reset Disable (Clear)
@@ -120,29 +124,51 @@ _config_info_default = [
 # fmt: on
 
 
+def sensitivity_for(min_delta, ref):
+    """Most sensitive SEN_PWM value (0-15, lower is more sensitive) whose
+    touch threshold is more than 'min_delta' away from reference value 'ref'.
+    With SSC=1 the threshold is (value x 0.2%)+0.15% of reference,
+    or (3 + 4 x value) steps of 0.05%
+    """
+    if ref == 0:  # channel not reading anything
+        return PADSENS
+    for v in range(16):
+        if ref * (3 + 4 * v) > min_delta * 2000:
+            return v
+    return 15
+
+
 class TS20:
     """Driver for the TS20 connected over I2C."""
 
     def __init__(
-        self, i2c, address=_TS20_DEFAULT_ADDRESS, config_info=_config_info_default
+        self, i2c, address=_TS20_DEFAULT_ADDRESS, config_info=_config_info_default,
+        only_changed=False
     ):
         self._i2c = i2c_device.I2CDevice(i2c, address)
+        self.num_transactions = 0  # I2C transactions so far, for benchmarking
         self._regbuf = bytearray(2)
-        self._touchcmd = bytes(_TS20_OUTPUT1,)
+        self._touchcmd = bytes((_TS20_OUTPUT1,))
         self._touchbuf = bytearray(3)
+        self._rawcmd = bytes((_TS20_SEN_H,))
+        self._rawbuf = bytearray(4)  # SEN_H, SEN_L, REF_H, REF_L
+        self.raw_sense = 0
+        self.raw_ref = 0
         self._touches = [0] * 21
-        self.write_config(config_info)
+        self.write_config(config_info, only_changed)
 
     def _write_register(self, reg_addr, reg_val):
         """Write 8 bit value to registter at address."""
         self._regbuf[0] = reg_addr
         self._regbuf[1] = reg_val
+        self.num_transactions += 1
         with self._i2c as i2c:
             i2c.write(self._regbuf)
 
     def _read_block(self, start, length) -> bytearray:
         """Return byte array of values from start address to length."""
         result = bytearray(length)
+        self.num_transactions += 1
         with self._i2c as i2c:
             i2c.write(bytes((start,)))
             i2c.readinto(result)
@@ -150,6 +176,7 @@ class TS20:
     
     def _read_block_to_buf(self, buf, start, length):
         """Return byte array of values from start address to length."""
+        self.num_transactions += 1
         with self._i2c as i2c:
             i2c.write(bytes((start,)))
             i2c.readinto(buf)
@@ -157,15 +184,55 @@ class TS20:
 
     def _write_block(self, start, data):
         """Write out data beginning at start address."""
+        self.num_transactions += 1
         with self._i2c as i2c:
             i2c.write(bytes((start,)) + data)
 
-    def write_config(self, config_info) -> None:
+    def write_config(self, config_info, only_changed=False) -> None:
         """Write configuration set to TS20
-        config_info is array of tuples (reg_addr, reg_val)
+        config_info is array of tuples (reg_addr, reg_val),
+        runs of consecutive register addresses are sent as one block write.
+        If only_changed, read the registers back first and only write
+        the ones that differ, e.g. on a warm restart nothing is written
         """
+        if only_changed:
+            config_info = self._config_changes(config_info)
+        start = 0
+        data = bytearray()
         for reg_addr, reg_val in config_info:
-            self._write_register(reg_addr, reg_val)
+            if data and reg_addr != start + len(data):  # not next in the block, send the block
+                self._write_block(start, data)
+                data = bytearray()
+            if not data:
+                start = reg_addr
+            data.append(reg_val)
+        if data:
+            self._write_block(start, data)
+
+    def _config_changes(self, config_info):
+        """Return the config_info entries whose registers don't already have their final values"""
+        final = {}
+        for reg_addr, reg_val in config_info:
+            final[reg_addr] = reg_val
+        lo = min(final)
+        current = self._read_block(lo, max(final) - lo + 1)
+        regs = sorted(final.items())
+        changes = []
+        last = -1  # index in regs of the last changed register
+        for i, (reg_addr, reg_val) in enumerate(regs):
+            if current[reg_addr - lo] == reg_val:
+                continue
+            if last >= 0 and reg_addr - regs[last][0] == i - last:
+                # rewrite the unchanged ones in between, one block write beats two
+                changes.extend(regs[last + 1:i])
+            changes.append((reg_addr, reg_val))
+            last = i
+        first, final_entry = config_info[0], config_info[-1]
+        if changes and first[0] == final_entry[0]:
+            # config holds the chip in reset while changing it (GTRL2), keep doing that
+            changes = ([first] + [(a, first[1]) if a == first[0] else (a, v) for a, v in changes]
+                       + [final_entry])
+        return changes
 
     # def read_touches_buf(self):
     #     self._read_block_to_buf(self._tbuf, _TS20_OUTPUT1, 3)
@@ -193,6 +260,67 @@ class TS20:
         # _touches = [t >> i & 1 for i in range(21)]  # bit21 is "isnoisy"
         # return _touches
     
+    def read_touch_mask(self):
+        """Read back touches as a single int bitmask, bit N set if channel N+1 is touched.
+        Bit 20 is "isnoisy". Reads into a preallocated buffer, doesn't allocate.
+        """
+        self.num_transactions += 1
+        with self._i2c as i2c:
+            i2c.write(self._touchcmd)
+            i2c.readinto(self._touchbuf)
+        tbuf = self._touchbuf
+        return (tbuf[0] | (tbuf[1] << 7) | (tbuf[2] << 15)) & 0x1FFFFF
+
+    def read_raw(self, channel=None):
+        """Read raw sensing and reference values of a channel (0-19)
+        into 'raw_sense' and 'raw_ref', return sensing minus reference.
+        With no channel, reads the same channel as last time, a transaction less.
+        Doesn't allocate, so it can be called continuously.
+        """
+        if channel is not None:
+            self._write_register(_TS20_SEN_RD_CTRL, channel)  # which channel SEN_H..REF_L show
+        self.num_transactions += 1
+        with self._i2c as i2c:
+            i2c.write(self._rawcmd)
+            i2c.readinto(self._rawbuf)
+        rbuf = self._rawbuf
+        self.raw_sense = (rbuf[0] << 8) | rbuf[1]
+        self.raw_ref = (rbuf[2] << 8) | rbuf[3]
+        return self.raw_sense - self.raw_ref
+
+    def read_raw_into(self, buf, num_channels=20):
+        """Read raw values of all channels into 'buf', e.g. array('H', [0] * 40),
+        buf[2*ch] is the sensing value and buf[2*ch+1] the reference value of channel ch
+        """
+        for ch in range(num_channels):
+            self.read_raw(ch)
+            buf[2 * ch] = self.raw_sense
+            buf[2 * ch + 1] = self.raw_ref
+        return buf
+
+    def calibrate(self, num_samples=16, margin=3, sample_millis=10, min_value=PADSENS - 2):
+        """Pick each channel's sensitivity from how noisy it is, then set them.
+        Call with nothing touching the pads. Takes 'num_samples' reads of every
+        channel, 'sample_millis' apart so the chip has measured again in between,
+        and picks the most sensitive setting whose threshold is more than
+        'margin' times the channel's biggest distance from its reference.
+        A channel that reads flat would get the most sensitive setting (0),
+        so none are set more sensitive than 'min_value'.
+        Returns list of the sensitivities set
+        """
+        raw = array('H', [0] * 40)
+        noise = [0] * 20
+        for i in range(num_samples):
+            if i:
+                time.sleep(sample_millis / 1000)
+            self.read_raw_into(raw)
+            for ch in range(20):
+                noise[ch] = max(noise[ch], abs(raw[2 * ch] - raw[2 * ch + 1]))
+        values = [max(min_value, sensitivity_for(noise[ch] * margin, raw[2 * ch + 1]))
+                  for ch in range(20)]
+        self.set_pad_sensitivities(values)
+        return values
+
     def read_touches_orig(self):
         """Read back touches
         Return list of booleans, one per pad.
@@ -220,7 +348,7 @@ class TS20:
         sens_vals[5] = values[10] << 4 | values[9]  # ch11,10
         sens_vals[6] = values[12] << 4 | values[11]  # ch13,12
         sens_vals[7] = values[14] << 4 | values[13]  # ch15,14
-        sens_vals[8] = values[16] << 4 | values[15]  # ch15,14
-        sens_vals[9] = values[18] << 4 | values[17]  # ch15,14
-        sens_vals[10] = values[19] << 4 | values[19]  # ch-,20
+        sens_vals[8] = values[16] << 4 | values[15]  # ch17,16
+        sens_vals[9] = values[18] << 4 | values[17]  # ch19,18
+        sens_vals[10] = 0b1111 << 4 | values[19]  # ch-,20
         return self._write_block(_TS20_SEN_PWM1, sens_vals)
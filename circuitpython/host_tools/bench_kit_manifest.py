@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_kit_manifest.py -- boot time of find_kits() with and without the kit manifest
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_kit_manifest.py [number of kits...]
+
+Makes a /drumkits-like tree of small WAV files in a temp dir, then times
+find_kits() three ways: scanning every kit directory (no manifest), the
+first boot that builds the manifest, boots that can't save it (read-only
+CIRCUITPY, so WAV headers are left to be read when a kit is loaded), and
+later boots that read it.
+Each phase also counts filesystem calls (listdir, stat, open), which is
+the number that matters on the drumcard: each one is a FAT directory
+walk on flash, much slower than on a desktop disk. On a desktop, reading
+the manifest takes about as long as scanning the kit dirs, so the manifest
+doesn't buy boot time as such: it saves the listdir()s, and holds each
+WAV's header info so the sample cache doesn't have to open a kit's files
+just to read their headers. Sample files are only stat()ed when their kit
+is loaded, by check_kit_files(), timed here too.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import wave
+
+import sim
+sim.install()
+
+import drum_kits
+
+SAMPLE_NAMES = ("00kick", "01snare", "02hatc", "03hato", "04clap", "05toml", "06ride", "07crash")
+
+
+class CountingOS:
+    """Wraps the os module to count filesystem calls"""
+    def __init__(self, read_only=False):
+        self.counts = {'listdir': 0, 'stat': 0, 'open': 0}
+        self.read_only = read_only  # like CIRCUITPY without a boot.py remount
+
+    def listdir(self, path):
+        self.counts['listdir'] += 1
+        return os.listdir(path)
+
+    def stat(self, path):
+        self.counts['stat'] += 1
+        return os.stat(path)
+
+    def open(self, path, mode='r', *args, **kwargs):
+        self.counts['open'] += 1
+        if self.read_only and 'w' in mode:
+            raise OSError(30, "Read-only filesystem")
+        return open(path, mode, *args, **kwargs)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rename(self, old, new):
+        os.rename(old, new)
+
+
+def make_kit_tree(root, num_kits):
+    frames = bytes(2 * 2205)  # 0.1 sec of silence, 22050 Hz 16-bit mono
+    for k in range(num_kits):
+        kit_dir = os.path.join(root, "kit%02d" % k)
+        os.mkdir(kit_dir)
+        for name in SAMPLE_NAMES:
+            with wave.open(os.path.join(kit_dir, name + ".wav"), 'wb') as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(22050)
+                w.writeframes(frames)
+
+
+def timed(fn, *args, repeats=20, read_only=False, **kwargs):
+    """Run fn, return (result, average millis, filesystem call counts of one run)"""
+    counter = CountingOS(read_only)
+    drum_kits.os = counter
+    drum_kits.open = counter.open
+    result = fn(*args, **kwargs)
+    counts = dict(counter.counts)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args, **kwargs)
+    millis = (time.perf_counter() - start) * 1000 / repeats
+    drum_kits.os = os
+    del drum_kits.open
+    return result, millis, counts
+
+
+def bench(num_kits):
+    with tempfile.TemporaryDirectory() as root:
+        make_kit_tree(root, num_kits)
+        index_path = root + "/.index"
+        print("%d kits, %d samples" % (num_kits, num_kits * len(SAMPLE_NAMES)))
+
+        scanned, scan_millis, scan_counts = timed(drum_kits.find_kits, root, use_index=False)
+
+        def first_boot():
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            with contextlib.redirect_stdout(io.StringIO()):  # quiet "rebuilding" message
+                return drum_kits.find_kits(root)
+        _, ro_millis, ro_counts = timed(first_boot, read_only=True)
+        _, build_millis, build_counts = timed(first_boot)
+
+        stamps, stamp_millis, stamp_counts = timed(drum_kits.kit_stamps, root)
+        _, read_millis, read_counts = timed(drum_kits.read_kit_index, index_path, stamps)
+        indexed, boot_millis, boot_counts = timed(drum_kits.find_kits, root)
+        _, check_millis, check_counts = timed(drum_kits.check_kit_files, indexed, "kit00")
+
+        assert indexed['kit_names'] == scanned['kit_names']
+        assert all(indexed[k] == scanned[k] for k in scanned['kit_names'])
+
+        def row(label, millis, counts):
+            print("  %-34s %8.2f ms  listdir %3d  stat %3d  open %3d" % (
+                label, millis, counts['listdir'], counts['stat'], counts['open']))
+        row("no manifest (scan every kit dir)", scan_millis, scan_counts)
+        row("first boot, builds manifest", build_millis, build_counts)
+        row("boot, read-only, can't save it", ro_millis, ro_counts)
+        row("boot with manifest", boot_millis, boot_counts)
+        row("  - check kit dir stamps", stamp_millis, stamp_counts)
+        row("  - read manifest", read_millis, read_counts)
+        row("check a kit's files when loading it", check_millis, check_counts)
+        print("  manifest size: %d bytes" % os.path.getsize(index_path))
+
+        # a sample swapped in an existing kit (kit dir mtime put back, like FAT can leave it)
+        kit_dir = os.path.join(root, "kit00")
+        dir_stat = os.stat(kit_dir)
+        with wave.open(os.path.join(kit_dir, SAMPLE_NAMES[0] + ".wav"), 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(22050)
+            w.writeframes(bytes(2 * 1000))
+        os.utime(kit_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        fname = indexed['kit00'][0]
+        kits = drum_kits.read_kit_index(index_path, drum_kits.kit_stamps(root))
+        with contextlib.redirect_stdout(io.StringIO()):  # quiet "changed" message
+            drum_kits.check_kit_files(kits, "kit00")
+        assert fname not in kits['wav_info']
+        print("  swapped sample in a kit: seen as changed when loading it")
+
+
+if __name__ == "__main__":
+    kit_counts = [int(a) for a in sys.argv[1:]] or [4, 32]
+    for n in kit_counts:
+        bench(n)
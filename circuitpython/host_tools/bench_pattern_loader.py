@@ -0,0 +1,76 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_pattern_loader.py -- time and peak memory of loading large pattern banks
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_pattern_loader.py [bank sizes...]
+
+Writes banks of random 32-step x 8-pad patterns in the saved_patterns.json
+format to a temp dir, then loads them with drum_sequencer.load_patterns()
+(streaming, one pattern at a time) in packed and list-of-lists form. For
+comparison it also loads them the naive way: json.load() of the whole
+file, then converting each row with str.replace() and int().
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sim
+sim.install()
+
+from drum_sequencer import load_patterns
+
+
+def make_bank_file(path, num_patterns, seed=1234):
+    rand = random.Random(seed)
+    patts = []
+    for i in range(num_patterns):
+        rows = [''.join('1' if rand.random() < 0.2 else '0' for _ in range(32))
+                for _ in range(8)]
+        patts.append({'name': f"patt{i}", 'seq': rows})
+    with open(path, 'w') as fp:
+        json.dump(patts, fp, indent=3)
+
+
+def load_naive(path):
+    with open(path) as fp:
+        patts = json.load(fp)
+    for p in patts:
+        rows = [[int(c) for c in s.replace(' ', '')] for s in p['seq']]
+        p['seq'] = [[rows[j][i] for j in range(len(rows))] for i in range(len(rows[0]))]
+    return patts
+
+
+def measure(fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    patts = fn()
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dt, peak, len(patts)
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_patterns in sizes:
+            path = os.path.join(tmpdir, f"bank{num_patterns}.json")
+            make_bank_file(path, num_patterns)
+            print(f"bank of {num_patterns} patterns, {os.path.getsize(path)} bytes on disk")
+            for name, fn in (
+                    ("naive json.load", lambda: load_naive(path)),
+                    ("stream lists", lambda: load_patterns(path)),
+                    ("stream packed", lambda: load_patterns(path, packed=True))):
+                dt, peak, n = measure(fn)
+                print(f"  {name:>16}: {dt * 1000:8.1f} ms  peak mem {peak:9d} bytes  ({n} loaded)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_pattern_storage.py -- compare list-of-lists vs packed sequence storage
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_pattern_storage.py [num_patterns]
+
+Reports heap used by a bank of patterns in each form (and packed with
+a velocity lane) and the cost of DrumSequencer.update() per step. Numbers are CPython's, so absolute
+sizes are larger than on the RP2040, but the ratio is what matters:
+a MicroPython list of 8 small ints is ~48 bytes plus its GC block
+rounding, vs one byte per step when packed.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import sim
+sim.install()
+
+import drum_patterns
+from drum_sequencer import DrumSequencer, make_sequence_from_pypattern, make_velocity_lane
+
+
+def make_bank(num_patterns, packed, with_vel=False):
+    demos = drum_patterns.patterns_demo
+    patts = []
+    for i in range(num_patterns):
+        p = demos[i % len(demos)]
+        patt = {'name': p['name'], 'seq': make_sequence_from_pypattern(p, packed)}
+        if packed:
+            patt['pads'] = len(p['seq'])
+        if with_vel:
+            patt['vel'] = make_velocity_lane(len(patt['seq']), len(p['seq']))
+        patts.append(patt)
+    return patts
+
+
+def measure_heap(num_patterns, packed, with_vel=False):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    bank = make_bank(num_patterns, packed, with_vel)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, bank
+
+
+def measure_update(bank, num_steps=20_000):
+    hits = 0
+    def trig_on(i, pos, vel=15):
+        nonlocal hits
+        hits += 1
+    seq = DrumSequencer(120, bank, trig_on=trig_on)
+    seq.playing = True
+    seq.change_pattern(0)
+    t0 = time.perf_counter()
+    for _ in range(num_steps):
+        sim.clock.set(seq.next_step_millis)
+        seq.update()
+    dt = time.perf_counter() - t0
+    return dt / num_steps * 1e6, hits
+
+
+def main():
+    num_patterns = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+    print(f"bank of {num_patterns} patterns, 32 steps x 8 pads")
+    for name, packed, with_vel in (("list-of-lists", False, False),
+                                   ("packed", True, False),
+                                   ("packed+vel", True, True)):
+        heap, bank = measure_heap(num_patterns, packed, with_vel)
+        usecs, hits = measure_update(bank)
+        print(f"{name:>14}: heap {heap:8d} bytes ({heap // num_patterns:5d}/pattern)"
+              f"  update() {usecs:6.2f} us/step  ({hits} trigs)")
+
+
+if __name__ == "__main__":
+    main()
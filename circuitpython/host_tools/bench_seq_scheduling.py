@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_seq_scheduling.py -- compare 1 ms polling vs deadline sleeping for the sequencer task
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_seq_scheduling.py [seconds]
+
+Simulates code.py's seq_updater() against a fake clock. Each asyncio
+sleep wakes up on time most of the time, and sometimes a few millis
+late because another task (UI, MIDI) was running. Reports how many
+times the task woke up per second and how late steps were played.
+"""
+
+import random
+import sys
+
+import sim
+sim.install()
+
+from drum_sequencer import DrumSequencer
+
+GUARD_MILLIS = 2  # same as code.py's seq_guard_millis
+
+
+def overshoot(rand):
+    """Extra millis an asyncio.sleep() takes when another task is busy"""
+    return rand.randint(1, 3) if rand.random() < 0.1 else 0
+
+
+def run(deadline_mode, seconds, bpm=120, seed=1234):
+    rand = random.Random(seed)
+    patts = [{'name': 'every', 'pads': 8, 'seq': bytearray(b'\x01' * 32)}]
+    sim.clock.set(0)
+    seq = DrumSequencer(bpm, patts)
+    seq.playing = True
+    late = []
+    wakeups = 0
+    end_millis = seconds * 1000
+    while sim.clock.now < end_millis:
+        wakeups += 1
+        if deadline_mode:
+            wait_millis = seq.millis_until_step() - GUARD_MILLIS
+            sim.clock.advance(max(wait_millis, 0) + overshoot(rand))
+            wait_millis = seq.millis_until_step()
+            if wait_millis > 0:  # tight wait
+                sim.clock.advance(wait_millis)
+            steps = seq.num_steps_played
+            seq.update()
+        else:
+            steps = seq.num_steps_played
+            seq.update()
+            sim.clock.advance(1 + overshoot(rand))
+        if seq.num_steps_played != steps:
+            late.append(seq.step_late)
+    return wakeups / seconds, late
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    print(f"{seconds} seconds at 120 bpm, 8 steps per beat")
+    for name, deadline_mode in (("polling", False), ("deadline", True)):
+        wakeups_per_sec, late = run(deadline_mode, seconds)
+        pcts = " ".join(f"p{p}={v}" for p, v in sim.percentiles(late))
+        print(f"{name:>9}: {wakeups_per_sec:7.1f} wakeups/sec, {len(late)} steps, late ms {pcts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_step_clock.py -- measure DrumSequencer step timing drift and jitter
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_step_clock.py [num_steps]
+
+Drives DrumSequencer.update() from a fake millisecond clock the way
+code.py's seq_updater() does: poll every 1 ms, with the occasional
+extra delay when another task hogs the interpreter. Every step has a
+trig on it, and the time each trig fires is compared to the ideal
+step grid. "drift" is where the last step landed vs where it should
+have, "jitter" is how far each step-to-step interval is from the exact
+step length.
+
+The old int step_millis / late_millis//2 clock is included for comparison.
+Also checks that heavy swing and microtiming, which can put a step right
+after the one before, don't make the clock restart and stretch the bar.
+"""
+
+import random
+import sys
+
+import sim
+sim.install()
+
+from adafruit_ticks import ticks_ms, ticks_diff, ticks_add
+from drum_sequencer import DrumSequencer
+
+
+class LegacyClockSequencer(DrumSequencer):
+    """The step clock as it was: truncated int step_millis plus a catch-up hack"""
+    def set_bpm(self, bpm):
+        super().set_bpm(bpm)
+        self.step_millis = int(60 * 1000 / bpm / self.steps_per_beat)
+
+    def update(self):
+        now = ticks_ms()
+        diff = ticks_diff(now, self.last_step_millis)
+        if diff < self.step_millis:
+            return
+        late_millis = ticks_diff(diff, self.step_millis)
+        self.last_step_millis = ticks_add(now, -(late_millis // 2))
+        if self.playing:
+            mask = self.sequence[self.pos]
+            i = 0
+            while mask:
+                if mask & 1:
+                    self.trig_on(i, self.pos)
+                mask >>= 1
+                i += 1
+        self.pos = (self.pos + 1) % self.num_steps
+
+
+def run(seq_class, bpm, num_steps, seed=1234):
+    rand = random.Random(seed)
+    hit_times = []
+    def trig_on(i, pos, vel=15):
+        hit_times.append(sim.clock.now)
+    patts = [{'name': 'every', 'pads': 8, 'seq': bytearray(b'\x01' * 32)}]
+    sim.clock.set(0)
+    seq = seq_class(bpm, patts, trig_on=trig_on)
+    seq.playing = True
+    while len(hit_times) < num_steps:
+        sim.clock.advance(1)  # asyncio.sleep(0.001)
+        if rand.random() < 0.05:
+            sim.clock.advance(rand.randint(1, 4))  # some other task ran long
+        seq.update()
+
+    step_exact = 60_000 / (bpm * seq.steps_per_beat)
+    t0 = hit_times[0]
+    errors = [t - (t0 + k * step_exact) for k, t in enumerate(hit_times)]
+    drift = errors[-1]
+    jitter = [abs((b - a) - step_exact) for a, b in zip(hit_times, hit_times[1:])]
+    return step_exact, drift, jitter
+
+
+def bar_lengths(patt_extra, bpm=120, num_bars=4):
+    """Return millis of each bar played of a 32nd-note pattern with 'patt_extra' keys"""
+    hit_times = []
+    def trig_on(i, pos, vel=15):
+        hit_times.append(sim.clock.now)
+    patts = [dict({'name': 'timed', 'pads': 8, 'seq': bytearray(b'\x01' * 32)}, **patt_extra)]
+    sim.clock.set(0)
+    seq = DrumSequencer(bpm, patts, trig_on=trig_on)
+    seq.playing = True
+    while len(hit_times) <= 32 * (num_bars + 1):
+        sim.clock.advance(1)
+        seq.update()
+    return [hit_times[k + 32] - hit_times[k] for k in range(32, 32 * (num_bars + 1), 32)]
+
+
+def main():
+    num_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    print(f"{num_steps} steps, 1 ms polling with random 1-4 ms stalls")
+    for bpm in (120, 133, 97.5):
+        for name, seq_class in (("legacy", LegacyClockSequencer), ("phase", DrumSequencer)):
+            step_exact, drift, jitter = run(seq_class, bpm, num_steps)
+            pcts = " ".join(f"p{p}={v:.2f}" for p, v in sim.percentiles(jitter))
+            print(f"bpm {bpm:6.1f} (step {step_exact:.3f} ms) {name:>6}: "
+                  f"drift {drift:+10.1f} ms  jitter ms {pcts}")
+    for name, patt_extra in (("swing 75", {'swing': 75}), ("micro +50/-50", {'micro': [50, -50] * 16})):
+        bars = bar_lengths(patt_extra)
+        print(f"bpm  120.0 {name}: bar ms {bars}")
+        assert bars == [2000] * len(bars), "bar stretched"
+
+
+if __name__ == "__main__":
+    main()
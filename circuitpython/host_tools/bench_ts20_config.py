@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+bench_ts20_config.py -- I2C transactions and time to configure the TS20
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 bench_ts20_config.py
+
+Runs ts20.TS20's config against a fake TS20 register file (sim.FakeTS20)
+that counts I2C transactions and bytes, three ways:
+- one register write per config entry, the way write_config() used to
+- coalesced block writes, on a cold start (chip at power-on defaults)
+- coalesced block writes with only_changed, on a cold and a warm start
+  (warm: the chip was already configured, e.g. after a soft reload)
+Init time is estimated for a 400 kHz bus: 9 clocks per byte plus a fixed
+cost per transaction for the CircuitPython call, bus lock, start and stop.
+"""
+
+import sim
+sim.install()
+
+import ts20
+
+I2C_HZ = 400_000
+TRANSACTION_MICROS = 60  # CircuitPython overhead per I2C transaction, roughly
+
+
+def init_micros(chip):
+    return chip.num_transactions * TRANSACTION_MICROS + chip.num_bytes * 9 * 1_000_000 // I2C_HZ
+
+
+class TS20PerRegister(ts20.TS20):
+    """TS20 driver writing one register per transaction, like before"""
+    def write_config(self, config_info, only_changed=False):
+        for reg_addr, reg_val in config_info:
+            self._write_register(reg_addr, reg_val)
+
+
+def run(name, driver, chip, only_changed=False):
+    chip.num_transactions = chip.num_bytes = 0
+    driver(chip, only_changed=only_changed)
+    print(f"  {name:>40}: {chip.num_transactions:3d} transactions, {chip.num_bytes:3d} bytes,"
+          f" {init_micros(chip) / 1000:.2f} ms")
+    return bytes(chip.regs)
+
+
+def main():
+    config = ts20._config_info_default
+    print(f"TS20 config: {len(config)} entries")
+    regs_old = run("per-register writes", TS20PerRegister, sim.FakeTS20())
+    regs_new = run("block writes", ts20.TS20, sim.FakeTS20())
+    chip = sim.FakeTS20()
+    regs_cold = run("block writes, only_changed, cold start", ts20.TS20, chip, only_changed=True)
+    regs_warm = run("block writes, only_changed, warm start", ts20.TS20, chip, only_changed=True)
+    chip.regs[ts20._TS20_SEN_PWM3] = 0xFF  # one register differs
+    regs_one = run("block writes, only_changed, one differs", ts20.TS20, chip, only_changed=True)
+    assert regs_old == regs_new == regs_cold == regs_warm == regs_one, "configs differ"
+    print("final register values match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+check_pad_velocity.py -- check pad_velocity.PadVelocity's rate-to-velocity mapping
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 check_pad_velocity.py
+
+Hits a pad on a fake TS20 (sim.FakeTS20) whose raw sensing value ramps
+away from reference at a set rate, in 1/1000ths of reference per ms,
+then calls PadVelocity.update() every millisecond, right after the tick,
+like touch_scanner() does until the pad is done.
+Each I2C read takes a little time on the fake clock, and the chip only
+measures again every REFRESH_MILLIS. Checks the velocity comes out the
+same whatever the read speed, goes up with the rate until it tops
+out at 15, and that pads hit together are measured together.
+Exits with an AssertionError if not.
+"""
+
+import sim
+sim.install()
+
+import ts20
+from pad_velocity import PadVelocity
+
+REF = 3000
+CHANNEL = 5
+REFRESH_MILLIS = 1  # how often the fake chip measures again
+WAKE_MILLIS = 0.05  # how long after a millisecond tick a sleeping task wakes
+
+
+class RampingTS20(sim.FakeTS20):
+    """A FakeTS20 whose CHANNEL ramps at 'rate' from when it's made, each read taking 'read_millis'"""
+    def __init__(self, rate, read_millis):
+        super().__init__()
+        self.rate = rate
+        self.read_millis = read_millis
+        self.t = 0.0  # fake clock, with fractions of millis
+        self.raw_ref[CHANNEL] = REF
+
+    def _measure(self):
+        measured_at = int(self.t // REFRESH_MILLIS) * REFRESH_MILLIS
+        self.raw_sense[CHANNEL] = REF + int(self.rate * REF * measured_at / 1000)
+        if self.regs[self.SEN_RD_CTRL] == CHANNEL:  # update what SEN_H..REF_L show
+            sense = self.raw_sense[CHANNEL]
+            self.regs[self.SEN_H:self.SEN_H + 4] = bytes((sense >> 8, sense & 0xFF, REF >> 8, REF & 0xFF))
+
+    def write(self, buf):
+        self._measure()
+        super().write(buf)
+
+    def readinto(self, buf):
+        self.t += self.read_millis
+        sim.clock.set(int(self.t))
+        self._measure()
+        super().readinto(buf)
+
+
+def velocity(rate, read_millis):
+    """Hit a pad ramping at 'rate' and measure it the way code.py's touch_scanner() does"""
+    sim.clock.set(0)
+    chip = RampingTS20(rate, read_millis)
+    pv = PadVelocity(ts20.TS20(chip))
+    chip.t = 0.37  # hit lands partway into a millisecond
+    pv.start(3, CHANNEL, sim.clock.now)
+    done = 0
+    while not done:
+        chip.t = int(chip.t) + 1 + WAKE_MILLIS  # asyncio.sleep(0.001)
+        sim.clock.set(int(chip.t))
+        done = pv.update()
+    assert done == 1 << 3
+    return pv.vels[3], pv.last_rate
+
+
+def main():
+    pv = PadVelocity(None)
+    print(f"window {pv.window_millis} ms, full_rate {pv.full_rate}, min_vel {pv.min_vel}")
+    last_vel = 0
+    for rate in (0, 1, 2, 4, 6, 8, 10, 20):
+        results = [velocity(rate, read_millis) for read_millis in (0.1, 0.25, 0.5)]
+        vels = [v for v, _ in results]
+        print(f"  rate {rate:2d}/1000 per ms: velocity {vels}  measured rate {[r for _, r in results]}")
+        assert len(set(vels)) == 1, "velocity depends on read speed"
+        vel = vels[0]
+        assert vel >= last_vel, "velocity went down with a faster hit"
+        expected = max(pv.min_vel, min(rate * 15 // pv.full_rate, 15))
+        assert abs(vel - expected) <= 1, f"expected velocity {expected}"
+        last_vel = vel
+    assert last_vel == 15
+
+    # two pads hit together are measured together, neither waits for the other
+    sim.clock.set(0)
+    chip = RampingTS20(10, 0.1)
+    pv = PadVelocity(ts20.TS20(chip))
+    pv.start(0, CHANNEL, 0)
+    pv.start(6, 2, 0)
+    updates = 0
+    done = 0
+    while pv.busy():
+        chip.t = int(chip.t) + 1 + WAKE_MILLIS
+        sim.clock.set(int(chip.t))
+        done |= pv.update()
+        updates += 1
+    print(f"  two pads at once: done after {updates} updates")
+    assert done == 0b1000001 and updates == pv.window_millis + 1
+    print("all pad velocity checks passed")
+
+
+if __name__ == "__main__":
+    main()
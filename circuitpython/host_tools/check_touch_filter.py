@@ -0,0 +1,49 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+check_touch_filter.py -- check touch_filter.TouchFilter on hand-made scans
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 check_touch_filter.py
+
+Feeds sequences of raw touch masks to a TouchFilter and checks which
+touches get through. Exits with an AssertionError if one doesn't.
+"""
+
+import sim
+sim.install()
+
+from touch_filter import TouchFilter, TOUCH_NOISY, ghost_triples, popcount
+
+PAD_1 = 1 << 0
+PAD_2 = 1 << 1
+PAD_3 = 1 << 2
+GHOST = ghost_triples[1]  # channels 9, 10, 11
+
+
+def check(name, scans, expected):
+    f = TouchFilter()
+    got = [f.update(raw) for raw in scans]
+    assert got == expected, f"{name}: got {[bin(m) for m in got]}, expected {[bin(m) for m in expected]}"
+    print(f"  ok: {name}")
+
+
+def main():
+    assert popcount((1 << 21) - 1) == 21
+    check("single pad", [PAD_1, PAD_1, 0], [PAD_1, PAD_1, 0])
+    check("ghost triple masked out", [GHOST, GHOST, 0], [0, 0, 0])
+    check("ghost triple + real pad, real pad kept",
+          [GHOST | PAD_1, GHOST | PAD_1, PAD_1, 0], [PAD_1, PAD_1, PAD_1, 0])
+    check("ghost triple + two real pads, both kept",
+          [GHOST | PAD_1 | PAD_2], [PAD_1 | PAD_2])
+    check("three new pads at once masked out", [PAD_1 | PAD_2 | PAD_3], [0])
+    check("held pad kept, new pad masked while noisy, kept when touched again next scan",
+          [PAD_1, PAD_1 | PAD_2 | TOUCH_NOISY, PAD_1 | PAD_2], [PAD_1, PAD_1, PAD_1 | PAD_2])
+    check("suspect pad needs two scans in a row",
+          [PAD_1 | TOUCH_NOISY, 0, PAD_1, PAD_1], [0, 0, 0, PAD_1])
+    check("releases during noise held, then released", [PAD_1, TOUCH_NOISY, 0], [PAD_1, PAD_1, 0])
+    print("all touch filter checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+pack_kits.py -- convert drum kits to the drumcard's audio format and pack them
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python (needs numpy):
+  python3 pack_kits.py [src_kit_root] [dest_kit_root]
+defaults are ../drum_machine/drumkits and ./packed_drumkits
+
+For each kit dir ("kit*") in src_kit_root, every WAV is:
+- mixed down to mono and converted to 16-bit at 22050 Hz, the format
+  the DrumCardHardware mixer runs at, so the chip never has to convert
+- trimmed of leading and trailing silence (below --thresh dB of the peak)
+- peak-normalized to --peak dBFS
+
+The results are written to dest_kit_root/<kit>/ as WAVs with the same
+names, plus a "kit.bin" holding all the kit's samples back-to-back with
+an offset table, so the drumcard can load a whole kit with one read.
+See drum_kits.read_kit_blob_info() for the kit.bin format.
+Copy dest_kit_root to CIRCUITPY/drumkits to use it.
+"""
+
+import argparse
+import os
+import struct
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 22050  # DrumCardHardware mixer sample rate
+PRE_ROLL_MILLIS = 1  # kept before the first sound, so attacks aren't clipped
+FADE_MILLIS = 5  # fade out at the end of a trimmed sample, to avoid a click
+
+
+def read_wav(path):
+    """Return (float32 array of shape (frames, channels) in -1..1, sample_rate)"""
+    with wave.open(path, 'rb') as w:
+        channels = w.getnchannels()
+        width = w.getsampwidth()
+        rate = w.getframerate()
+        raw = w.readframes(w.getnframes())
+    if width == 1:  # 8-bit WAVs are unsigned
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        data = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768
+    elif width == 3:  # 24-bit, sign-extend into the top of an int32
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        data = ((b[:, 0] << 8 | b[:, 1] << 16 | b[:, 2] << 24) >> 8).astype(np.float32) / 8388608
+    elif width == 4:
+        data = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648
+    else:
+        raise ValueError("unsupported sample width %d: %s" % (width, path))
+    return data.reshape(-1, channels), rate
+
+
+def resample(data, rate_in, rate_out):
+    """FFT resample a mono float array, band-limited so downsampling doesn't alias"""
+    if rate_in == rate_out or len(data) == 0:
+        return data
+    n_out = max(1, round(len(data) * rate_out / rate_in))
+    spectrum = np.fft.rfft(data)
+    n_bins = n_out // 2 + 1
+    if n_bins <= len(spectrum):
+        spectrum = spectrum[:n_bins]
+    else:
+        spectrum = np.concatenate([spectrum, np.zeros(n_bins - len(spectrum), spectrum.dtype)])
+    return np.fft.irfft(spectrum, n_out).astype(np.float32) * (n_out / len(data))
+
+
+def trim_silence(data, thresh_db):
+    """Cut leading and trailing audio quieter than thresh_db below the peak"""
+    peak = np.max(np.abs(data)) if len(data) else 0
+    if peak == 0:
+        return data[:0]
+    loud = np.nonzero(np.abs(data) >= peak * 10 ** (thresh_db / 20))[0]
+    start = max(0, loud[0] - SAMPLE_RATE * PRE_ROLL_MILLIS // 1000)
+    end = loud[-1] + 1
+    trimmed = data[start:end].copy()
+    if end < len(data):  # tail was cut, fade what's left of it out
+        fade = min(len(trimmed), SAMPLE_RATE * FADE_MILLIS // 1000)
+        trimmed[len(trimmed) - fade:] *= np.linspace(1, 0, fade, dtype=np.float32)
+    return trimmed
+
+
+def convert(path, thresh_db, peak_db):
+    """Return int16 mono SAMPLE_RATE version of WAV file at path"""
+    data, rate = read_wav(path)
+    data = data.mean(axis=1)
+    data = resample(data, rate, SAMPLE_RATE)
+    data = trim_silence(data, thresh_db)
+    peak = np.max(np.abs(data)) if len(data) else 0
+    if peak > 0:
+        data = data * (10 ** (peak_db / 20) / peak)
+    return np.clip(np.round(data * 32767), -32768, 32767).astype('<i2')
+
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(samples.tobytes())
+
+
+def write_kit_blob(path, sample_list):
+    """Write "kit.bin": header, offset table, then each sample, 4-byte aligned"""
+    table = []
+    data = bytearray()
+    for samples in sample_list:
+        table.append((len(data), samples.nbytes))
+        data += samples.tobytes()
+        data += bytes(-len(data) % 4)
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack('<4sHHIHH', b'DKIT', 1, len(sample_list), SAMPLE_RATE, 1, 16))
+        for off, n in table:
+            fp.write(struct.pack('<II', off, n))
+        fp.write(data)
+
+
+def pack_kit(src_dir, dest_dir, thresh_db, peak_db, verbose=False):
+    """Convert and pack one kit, return (source bytes, kit.bin bytes)"""
+    os.makedirs(dest_dir, exist_ok=True)
+    # same sample order as drum_kits.scan_kits()
+    names = sorted(n.lower() for n in os.listdir(src_dir)
+                   if n.lower().endswith(".wav") and not n.startswith("."))
+    src_bytes = 0
+    sample_list = []
+    for name in names:
+        src_path = os.path.join(src_dir, name)
+        if not os.path.exists(src_path):  # filesystem is case-sensitive
+            src_path = os.path.join(src_dir, next(n for n in os.listdir(src_dir) if n.lower() == name))
+        samples = convert(src_path, thresh_db, peak_db)
+        write_wav(os.path.join(dest_dir, name), samples)
+        sample_list.append(samples)
+        src_bytes += os.path.getsize(src_path)
+        if verbose:
+            _, rate = read_wav(src_path)
+            print("    %-24s %6d Hz -> %6d bytes" % (name, rate, samples.nbytes))
+    blob_path = os.path.join(dest_dir, "kit.bin")
+    write_kit_blob(blob_path, sample_list)
+    return src_bytes, os.path.getsize(blob_path)
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="convert and pack drum kits for the drumcard")
+    parser.add_argument('src', nargs='?', default=os.path.join(here, '..', 'drum_machine', 'drumkits'))
+    parser.add_argument('dest', nargs='?', default='packed_drumkits')
+    parser.add_argument('--thresh', type=float, default=-60, help="silence threshold, dB below peak")
+    parser.add_argument('--peak', type=float, default=-0.3, help="normalize peak to this dBFS")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    total_src = total_packed = 0
+    for kit_name in sorted(os.listdir(args.src)):
+        src_dir = os.path.join(args.src, kit_name)
+        if not kit_name.lower().startswith("kit") or not os.path.isdir(src_dir):
+            continue
+        print(kit_name.lower())
+        src_bytes, packed_bytes = pack_kit(src_dir, os.path.join(args.dest, kit_name.lower()),
+                                           args.thresh, args.peak, args.verbose)
+        total_src += src_bytes
+        total_packed += packed_bytes
+        print("  %7d bytes of WAVs -> %7d bytes kit.bin (%.1f%% smaller)" % (
+            src_bytes, packed_bytes, 100 * (1 - packed_bytes / src_bytes)))
+    if total_src:
+        print("total: %d -> %d bytes (%.1f%% smaller)" % (
+            total_src, total_packed, 100 * (1 - total_packed / total_src)))
+
+
+if __name__ == "__main__":
+    main()
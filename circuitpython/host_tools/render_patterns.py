@@ -0,0 +1,195 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+render_patterns.py -- render drum patterns to WAV files offline, without the drumcard
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python (needs numpy):
+  python3 render_patterns.py [--patterns saved_patterns.json] [--kit drumkits/kit0_909]
+                             [--pattern N | --all] [--bpm 120] [--seconds 60]
+                             [--out render.wav | --out-dir renders/] [--expect SHA256]
+
+Step timing comes from running the real DrumSequencer on sim.py's fake
+clock, so swing, microtiming, polymeter, velocity lanes and song-mode
+switches come out the same as on the drumcard. Each trigger goes through
+the real drum_voices.VoiceAllocator (same reserved synth voice and choke
+groups as code.py) on fake mixer voices that log what they play. The log
+is then mixed with numpy like the 22050 Hz mono audiomixer.Mixer does:
+each voice plays its sample at its level until the sample ends or the
+voice is retriggered, choked or stolen, and the sum is clipped to 16 bits.
+
+Trigger times are to the millisecond, like the sequencer. The mixer's
+buffering delay isn't modeled; it's the same for every step.
+
+Each render prints a SHA256 of its audio. Use --expect to check a render
+against a known-good hash, e.g. to check a sequencer change doesn't
+change what it plays. Exits with status 1 if it doesn't match.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+
+import sim
+sim.install()
+
+import drum_patterns
+from drum_sequencer import DrumSequencer, load_patterns, make_pattern
+from drum_voices import VoiceAllocator
+from pack_kits import read_wav, resample, SAMPLE_RATE
+
+# same as code.py
+VEL_TO_LEVEL = tuple((v / 15) ** 2 for v in range(16))
+NUM_VOICES = 8  # DrumCardHardware default
+RESERVED_VOICES = 1  # voice 0 plays the synth
+CHOKE_GROUPS = ((2, 3),)
+
+
+class RenderVoice:
+    """Stands in for an audiomixer MixerVoice, logs what it's told to play"""
+    def __init__(self, index, log, sample_millis):
+        self.index = index
+        self.log = log
+        self.sample_millis = sample_millis  # length of each pad's sample in millis
+        self.level = 1.0
+        self.end_millis = 0
+
+    @property
+    def playing(self):
+        return sim.clock.now < self.end_millis
+
+    def play(self, pad, loop=False):
+        self.log.append((sim.clock.now, self.index, pad, self.level))
+        self.end_millis = sim.clock.now + self.sample_millis[pad]
+
+    def stop(self):
+        self.log.append((sim.clock.now, self.index, -1, 0))
+        self.end_millis = 0
+
+
+class RenderMixer:
+    def __init__(self, num_voices, log, sample_millis):
+        self.voice = [RenderVoice(i, log, sample_millis) for i in range(num_voices)]
+
+
+def load_kit(kit_dir):
+    """Return list of float32 sample arrays at SAMPLE_RATE, in the same order as drum_kits.scan_kits()"""
+    names = sorted((n for n in os.listdir(kit_dir)
+                    if n.lower().endswith(".wav") and not n.startswith(".")), key=str.lower)
+    samples = []
+    for name in names:
+        data, rate = read_wav(os.path.join(kit_dir, name))
+        samples.append(resample(data.mean(axis=1), rate, SAMPLE_RATE) * 32768)
+    return samples
+
+
+def play_events(patterns, patt_index, sample_millis, bpm, seconds, song=None):
+    """Run the sequencer on the fake clock, return log of (millis, voice, pad or -1 for stop, level)"""
+    log = []
+    voices = VoiceAllocator(RenderMixer(NUM_VOICES, log, sample_millis),
+                            num_pads=len(sample_millis), reserved=RESERVED_VOICES,
+                            choke_groups=CHOKE_GROUPS)
+
+    def drum_on(pad, pos, vel=15):
+        voices.play(pad, pad, VEL_TO_LEVEL[vel], vel)
+
+    sim.clock.set(0)
+    seq = DrumSequencer(bpm, patterns, trig_on=drum_on)
+    seq.change_pattern(patt_index)
+    if song:
+        seq.set_song(song)
+    seq.playing = True
+    end_millis = seconds * 1000
+    while seq.next_step_millis < end_millis:
+        sim.clock.set(seq.next_step_millis)
+        seq.update()
+    return log
+
+
+def mix(log, samples, seconds):
+    """Mix the voice log to int16 mono audio"""
+    num_frames = seconds * SAMPLE_RATE
+    out = np.zeros(num_frames, dtype=np.float32)
+    starts = [m * SAMPLE_RATE // 1000 for m, _, _, _ in log]
+    next_start = [num_frames] * len(log)  # when each play is cut off by the next event on its voice
+    last_on_voice = {}
+    for i, (_, v, _, _) in enumerate(log):
+        if v in last_on_voice:
+            next_start[last_on_voice[v]] = starts[i]
+        last_on_voice[v] = i
+    for i, (_, _, pad, level) in enumerate(log):
+        if pad < 0 or level == 0:
+            continue
+        start = starts[i]
+        n = min(len(samples[pad]), next_start[i] - start, num_frames - start)
+        if n > 0:
+            out[start:start + n] += samples[pad][:n] * level
+    return np.clip(np.round(out), -32768, 32767).astype('<i2')
+
+
+def write_wav(path, audio):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(audio.tobytes())
+
+
+def render(patterns, patt_index, samples, bpm, seconds, song=None):
+    """Return (int16 audio, number of triggers)"""
+    sample_millis = [len(s) * 1000 // SAMPLE_RATE + 1 for s in samples]
+    log = play_events(patterns, patt_index, sample_millis, bpm, seconds, song)
+    return mix(log, samples, seconds), sum(1 for e in log if e[2] >= 0)
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="render drum patterns to WAV offline")
+    parser.add_argument('--patterns', help="saved_patterns.json file, default is the demo patterns")
+    parser.add_argument('--kit', default=os.path.join(here, '..', 'drum_machine', 'drumkits', 'kit0_909'))
+    parser.add_argument('--pattern', type=int, default=0, help="pattern number to render")
+    parser.add_argument('--all', action='store_true', help="render every pattern, to --out-dir")
+    parser.add_argument('--bpm', type=float, default=120)
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--out', default='render.wav')
+    parser.add_argument('--out-dir', default='renders')
+    parser.add_argument('--expect', help="SHA256 the render should have, exit 1 if not")
+    args = parser.parse_args()
+
+    if args.patterns:
+        patterns = load_patterns(args.patterns, packed=True)
+    else:
+        patterns = [make_pattern(p, True) for p in drum_patterns.patterns_demo]
+    samples = load_kit(args.kit)
+
+    if args.all:
+        os.makedirs(args.out_dir, exist_ok=True)
+        jobs = [(i, os.path.join(args.out_dir, "pattern%03d.wav" % i)) for i in range(len(patterns))]
+    else:
+        jobs = [(args.pattern, args.out)]
+    ok = True
+    start = time.perf_counter()
+    for patt_index, path in jobs:
+        t = time.perf_counter()
+        audio, num_trigs = render(patterns, patt_index, samples, args.bpm, args.seconds)
+        millis = (time.perf_counter() - t) * 1000
+        write_wav(path, audio)
+        digest = hashlib.sha256(audio.tobytes()).hexdigest()
+        print("%s: pattern %d '%s', %d trigs, %d sec in %.0f ms, sha256 %s" % (
+            path, patt_index, patterns[patt_index]['name'], num_trigs, args.seconds, millis, digest))
+        if args.expect and digest != args.expect:
+            ok = False
+    if len(jobs) > 1:
+        print("%d patterns in %.2f sec" % (len(jobs), time.perf_counter() - start))
+    if args.expect:
+        print("matches expected" if ok else "DOES NOT match expected")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+sim.py -- host-side simulation helpers for the drum_machine code
+Part of https://github.com/todbot/picotouch_drumcard
+
+Lets the drum_machine modules be imported and driven under desktop Python
+for benchmarks and timing simulations. The CircuitPython tick functions
+are replaced with a fake clock that the caller advances by hand, e.g.:
+
+    import sim
+    sim.install()
+    from drum_sequencer import DrumSequencer
+    ...
+    sim.clock.advance(1)  # one millisecond passes
+"""
+
+import os
+import sys
+import types
+
+DRUM_MACHINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'drum_machine')
+
+# same wraparound behavior as adafruit_ticks
+_TICKS_PERIOD = 1 << 29
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+
+class FakeClock:
+    """
+    A millisecond clock that only moves when told to,
+    or by 'millis_per_read' each time it's read, for code that spins on it
+    """
+    def __init__(self, start_millis=0):
+        self.now = start_millis
+        self.millis_per_read = 0
+
+    def advance(self, millis):
+        self.now += millis
+
+    def set(self, millis):
+        self.now = millis
+
+
+clock = FakeClock()
+
+
+def ticks_ms():
+    clock.now += clock.millis_per_read
+    return clock.now & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) & _TICKS_MAX
+    return ((diff + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def ticks_less(ticks1, ticks2):
+    return ticks_diff(ticks1, ticks2) < 0
+
+
+class FakeAudioSample:
+    """Stands in for audiocore.WaveFile and audiocore.RawSample"""
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+class FakeTS20:
+    """
+    Stands in for a busio.I2C with a TS20 on it: a file of registers that
+    auto-increments its address on block reads and writes like the chip does.
+    Counts I2C transactions and bytes, including address bytes.
+    Writing a channel number to SEN_RD_CTRL shows that channel's
+    raw_sense[ch] and raw_ref[ch] in SEN_H, SEN_L, REF_H, REF_L.
+    """
+    SEN_RD_CTRL = 0x28
+    SEN_H = 0x33
+
+    def __init__(self, num_regs=0x40):
+        self.regs = bytearray(num_regs)
+        self.addr = 0
+        self.num_transactions = 0
+        self.num_bytes = 0
+        self.raw_sense = [0] * 20
+        self.raw_ref = [0] * 20
+
+    def write(self, buf):
+        self.num_transactions += 1
+        self.num_bytes += 1 + len(buf)
+        self.addr = buf[0]
+        for b in buf[1:]:
+            self.regs[self.addr] = b
+            if self.addr == self.SEN_RD_CTRL and b < 20:
+                sense, ref = self.raw_sense[b], self.raw_ref[b]
+                self.regs[self.SEN_H:self.SEN_H + 4] = bytes((sense >> 8, sense & 0xFF, ref >> 8, ref & 0xFF))
+            self.addr += 1
+
+    def readinto(self, buf):
+        self.num_transactions += 1
+        self.num_bytes += 1 + len(buf)
+        for i in range(len(buf)):
+            buf[i] = self.regs[self.addr]
+            self.addr += 1
+
+
+class FakeI2CDevice:
+    """Stands in for adafruit_bus_device.i2c_device.I2CDevice, 'i2c' is a FakeTS20"""
+    def __init__(self, i2c, device_address):
+        self.i2c = i2c
+
+    def __enter__(self):
+        return self.i2c
+
+    def __exit__(self, *exc):
+        return False
+
+
+def install():
+    """Put the fake clock in place of adafruit_ticks, fake audiocore and I2C, and make drum_machine importable"""
+    mod = types.ModuleType('adafruit_ticks')
+    mod.ticks_ms = ticks_ms
+    mod.ticks_add = ticks_add
+    mod.ticks_diff = ticks_diff
+    mod.ticks_less = ticks_less
+    sys.modules['adafruit_ticks'] = mod
+    # audiocore objects only remember how they were made, there's no audio on the host
+    mod = types.ModuleType('audiocore')
+    mod.WaveFile = FakeAudioSample
+    mod.RawSample = FakeAudioSample
+    sys.modules['audiocore'] = mod
+    # enough of micropython and adafruit_bus_device for ts20.py to run against a FakeTS20
+    mod = types.ModuleType('micropython')
+    mod.const = lambda x: x
+    sys.modules['micropython'] = mod
+    mod = types.ModuleType('adafruit_bus_device.i2c_device')
+    mod.I2CDevice = FakeI2CDevice
+    sys.modules['adafruit_bus_device.i2c_device'] = mod
+    mod = types.ModuleType('adafruit_bus_device')
+    mod.i2c_device = sys.modules['adafruit_bus_device.i2c_device']
+    sys.modules['adafruit_bus_device'] = mod
+    if DRUM_MACHINE_DIR not in sys.path:
+        sys.path.insert(0, DRUM_MACHINE_DIR)
+
+
+def percentiles(vals, pcts=(50, 90, 99, 100)):
+    """Return list of (pct, value) for a list of numbers"""
+    svals = sorted(vals)
+    n = len(svals)
+    return [(p, svals[min(n - 1, (p * n) // 100)]) for p in pcts]
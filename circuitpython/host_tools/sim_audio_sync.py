@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+sim_audio_sync.py -- simulate hit-to-hit timing jitter with and without audio sync
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 sim_audio_sync.py [seconds]
+
+Runs DrumSequencer on the fake clock the way code.py's seq_updater() does
+(deadline sleeping, with sleeps sometimes running late), playing a hit
+on every step. Each hit is heard the way audiomixer.Mixer plays it: at the
+start of the buffer after the next one from when voice.play() was called,
+plus any silence in front of the sample. The real time of a call is
+somewhere within the millisecond ticks_ms() says, and the mixer's buffers
+start a fraction of a millisecond off from when audio output was started.
+
+Prints the spread of (heard time - step deadline) and of the error in the
+time between hits (inter-onset interval), without audio sync (hits start
+wherever they land in a buffer) and with it (steps played lead_millis early,
+silence in front from audio_clock.AudioClock). With audio sync, hits that
+come within AudioClock's margin of a buffer boundary wait past it, since
+the millisecond clock can't tell which side of the boundary they're on.
+The last run pads samples for 'normal' buffers while playing 'safe' ones,
+like code.py did before sizing the padding for the biggest buffer 'auto'
+can switch to: the padding runs out and hits land anywhere again.
+"""
+
+import random
+import sys
+
+import sim
+sim.install()
+
+from drum_sequencer import DrumSequencer
+from audio_clock import AudioClock
+from audio_latency import latency_profiles, buffer_millis
+
+SAMPLE_RATE = 22050
+GUARD_MILLIS = 2  # same as code.py's seq_guard_millis
+LEAD_MILLIS = 3  # same as code.py's seq_lead_millis
+PAD_STEP = 32
+PHASE_MILLIS = 0.3  # how far the real buffer boundaries are off from audio_start_millis
+
+
+def overshoot(rand):
+    """Extra millis an asyncio.sleep() takes when another task is busy"""
+    return rand.randint(1, 3) if rand.random() < 0.1 else 0
+
+
+def run(buffer_size, sync, seconds, seed=1234, pad_buffer_size=None):
+    """
+    Return list of (heard millis, deadline millis) of each hit.
+    Samples are padded for buffers of 'pad_buffer_size', if not the one playing
+    """
+    rand = random.Random(seed)
+    buf_ms = buffer_millis(buffer_size, SAMPLE_RATE)
+    clock = AudioClock(SAMPLE_RATE, buffer_size, start_millis=0, pad_step=PAD_STEP)
+    pad_clock = AudioClock(SAMPLE_RATE, pad_buffer_size or buffer_size, pad_step=PAD_STEP)
+    num_variants = pad_clock.max_pad_samples(LEAD_MILLIS) // PAD_STEP + 1
+    hits = []
+
+    def drum_on(pad, pos, vel=15):
+        if sync:
+            sim.clock.millis_per_read = 1  # AudioClock may spin past a buffer boundary
+            pad_samples = clock.variant(seq.step_deadline, num_variants) * PAD_STEP
+            sim.clock.millis_per_read = 0
+        else:
+            pad_samples = 0
+        now_real = sim.clock.now + rand.random()  # ticks_ms() truncates
+        k = int((now_real - PHASE_MILLIS) // buf_ms)  # buffer playing now
+        heard = (k + 2) * buf_ms + PHASE_MILLIS + pad_samples * 1000 / SAMPLE_RATE
+        hits.append((heard, seq.step_deadline))
+
+    patts = [{'name': 'every', 'pads': 8, 'seq': bytearray(b'\x01' * 32)}]
+    sim.clock.set(0)
+    seq = DrumSequencer(120, patts, trig_on=drum_on)
+    seq.lead_millis = LEAD_MILLIS if sync else 0
+    seq.playing = True
+    while sim.clock.now < seconds * 1000:
+        wait_millis = seq.millis_until_step() - GUARD_MILLIS
+        sim.clock.advance(max(wait_millis, 0) + overshoot(rand))
+        wait_millis = seq.millis_until_step()
+        if wait_millis > 0:  # tight wait
+            sim.clock.advance(wait_millis)
+        seq.update()
+    return hits
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    print(f"{seconds} seconds at 120 bpm, a hit every step")
+    for name, pad_name in (('normal', None), ('low', None), ('safe', 'safe'), ('safe', 'normal')):
+        size = latency_profiles[name]
+        print(f"{name} latency ({size} byte buffers, {buffer_millis(size):.1f} ms),"
+              f" samples padded for {pad_name or name}")
+        for sync in (False, True):
+            hits = run(size, sync, seconds, pad_buffer_size=latency_profiles[pad_name or name])
+            latency = [h - d for h, d in hits]
+            ioi_err = [abs((h2 - h1) - (d2 - d1)) for (h1, d1), (h2, d2) in zip(hits, hits[1:])]
+            pcts = " ".join(f"p{p}={v:4.1f}" for p, v in sim.percentiles(ioi_err))
+            print(f"  audio sync {'on ' if sync else 'off'}: latency {min(latency):5.1f}-{max(latency):5.1f} ms,"
+                  f" inter-onset error ms {pcts}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+sim_mixer_latency.py -- simulate mixer buffer size vs latency and underruns
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 sim_mixer_latency.py [seconds]
+
+Models audiomixer.Mixer's double buffering on a simulated sample clock:
+buffer k starts playing at k * buffer_length, and gets mixed when buffer
+k-1 starts playing, unless the CPU is stalled then (flash write, file
+open, gc), in which case it's mixed when the stall ends. If it's mixed
+after it should have started playing, that's an underrun (a glitch).
+A voice.play() call is heard at the start of the first buffer mixed
+after it, so trigger-to-output latency is that start time minus the call.
+
+For a few task loads it prints latency percentiles and underruns for
+each audio_latency profile, then what audio_latency.LatencyTuner picks
+("auto") when fed the same stalls the latency_handler task in code.py
+would see.
+"""
+
+import bisect
+import random
+import sys
+
+import sim
+sim.install()
+
+from audio_latency import latency_profiles, buffer_millis, LatencyTuner
+
+SAMPLE_RATE = 22050
+STEP_MILLIS = 500 / 8  # sequencer steps at 120 bpm, 8 steps per beat
+
+
+def make_stalls(load, seconds, rand):
+    """Return sorted list of (start_millis, length_millis) the CPU is busy with something else"""
+    stalls = []
+    end = seconds * 1000
+    t = 0.0
+    while t < end:  # touch scans, MIDI, LEDs: frequent short stalls
+        t += rand.expovariate(1 / 5)
+        stalls.append((t, rand.uniform(0.2, 2)))
+    t = 0.0
+    while t < end:  # gc
+        t += rand.uniform(1500, 2500)
+        stalls.append((t, rand.uniform(3, 6)))
+    if load in ('saving', 'kit loading'):
+        t = 0.0
+        while t < end:  # pattern journal writes
+            t += rand.uniform(9000, 11000)
+            stalls.append((t, rand.uniform(15, 35)))
+    if load == 'kit loading':
+        t = 0.0
+        while t < end:  # a kit switch every few seconds, one file open per slice
+            t += rand.uniform(4000, 6000)
+            for i in range(8):
+                stalls.append((t + i * 20, rand.uniform(8, 18)))
+    stalls.sort()
+    return stalls
+
+
+def merge_stalls(stalls):
+    """Merge overlapping stalls, return (list of starts, list of ends)"""
+    starts, ends = [], []
+    for start, length in stalls:
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], start + length)
+        else:
+            starts.append(start)
+            ends.append(start + length)
+    return starts, ends
+
+
+def busy_until(busy, t):
+    """If time t is inside a stall, return when it ends, else t"""
+    starts, ends = busy
+    i = bisect.bisect_right(starts, t) - 1
+    if i >= 0 and t < ends[i]:
+        return ends[i]
+    return t
+
+
+def simulate(stalls, buffer_size, seconds):
+    """Return (list of trigger latencies in millis, number of underruns)"""
+    busy = merge_stalls(stalls)
+    buf_ms = buffer_millis(buffer_size, SAMPLE_RATE)
+    num_bufs = int(seconds * 1000 / buf_ms)
+    mixed_at = [0.0] * num_bufs
+    underruns = 0
+    for k in range(1, num_bufs):
+        mixed_at[k] = busy_until(busy, (k - 1) * buf_ms)
+        if mixed_at[k] > k * buf_ms:
+            underruns += 1
+    latencies = []
+    k = 1
+    t = 0.0
+    while True:
+        t += STEP_MILLIS
+        play_at = busy_until(busy, t)  # the sequencer can't run during a stall either
+        while k < num_bufs and mixed_at[k] < play_at:
+            k += 1
+        if k >= num_bufs:
+            break
+        latencies.append(k * buf_ms - play_at)
+    return latencies, underruns
+
+
+def auto_pick(stalls):
+    """
+    Feed stalls to a LatencyTuner like latency_handler() does while
+    stopped, return the profile it ends up on
+    """
+    tuner = LatencyTuner(SAMPLE_RATE)
+    latency = 'normal'
+    for start, length in stalls:
+        sim.clock.set(int(start + length))
+        tuner.note_stall(int(length + 0.5))
+        latency = tuner.pick(latency)
+    return latency
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    print(f"{seconds} seconds, triggers every {STEP_MILLIS} ms")
+    for load in ('idle', 'saving', 'kit loading'):
+        stalls = make_stalls(load, seconds, random.Random(1234))
+        print(f"load: {load}, longest stall {max(l for _, l in stalls):.1f} ms")
+        picked = auto_pick(stalls)
+        for name in sorted(latency_profiles, key=lambda n: latency_profiles[n]):
+            size = latency_profiles[name]
+            latencies, underruns = simulate(stalls, size, seconds)
+            pcts = " ".join(f"p{p}={v:5.1f}" for p, v in sim.percentiles(latencies))
+            auto = "  <- auto" if name == picked else ""
+            print(f"  {name:>7} ({size:4d} bytes): latency ms {pcts}  underruns {underruns:3d}{auto}")
+
+
+if __name__ == "__main__":
+    main()
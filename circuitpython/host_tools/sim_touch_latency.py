@@ -0,0 +1,89 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 Tod Kurt
+# SPDX-License-Identifier: MIT
+"""
+sim_touch_latency.py -- simulate touch-to-trigger latency of the touch scanning
+Part of https://github.com/todbot/picotouch_drumcard
+
+Run on desktop Python:  python3 sim_touch_latency.py [seconds]
+
+Taps drum pads at random times and measures how long until drum_on() runs:
+- before: ui_handler() reading the pads every 50 ms, after its LED housekeeping
+- after: touch_scanner() reading the pads every touch_scan_millis, pushing
+  edges into a touch_events.TouchEvents ring and triggering from it right away
+Either task can only wake up when the other tasks aren't holding up the
+event loop, using the same idle task load as sim_mixer_latency.py.
+Doesn't include the TS20's own response time, which is the same for both.
+"""
+
+import random
+import sys
+
+import sim
+sim.install()
+
+from touch_events import TouchEvents
+from sim_mixer_latency import make_stalls, merge_stalls, busy_until
+
+UI_MILLIS = 50  # ui_handler()'s old touch_scan_millis
+SCAN_MILLIS = 3  # code.py's touch_scan_millis
+LED_WORK_MILLIS = 0.3  # ui_handler()'s LED updates before reading the pads
+READ_MILLIS = 0.2  # I2C read of the three TS20 output registers at 400 kHz
+TAP_MILLIS = 60  # how long a finger stays on a pad
+
+
+def make_taps(seconds, rand):
+    """Return list of (touch millis, padid)"""
+    taps = []
+    t = 100.0
+    while t < seconds * 1000:
+        taps.append((t, rand.randrange(8)))
+        t += rand.uniform(100, 400)
+    return taps
+
+
+def touching(taps, t):
+    """Return {padid: touch millis} of the taps a finger is on at time t"""
+    return {pad: start for start, pad in taps if start <= t < start + TAP_MILLIS}
+
+
+def run(taps, busy, seconds, sleep_millis, work_millis):
+    """Return list of millis from each tap to its trigger"""
+    events = TouchEvents(size=32)
+    reader = events.reader()
+    latencies = []
+    i = 0  # taps before this one are over
+    t = 0.0
+    while t < seconds * 1000:
+        t = busy_until(busy, t + sleep_millis) + work_millis
+        while i < len(taps) and taps[i][0] + TAP_MILLIS <= t:
+            i += 1
+        touched = touching(taps[i:i + 4], t)
+        mask = 0
+        for pad in touched:
+            mask |= 1 << pad
+        t += READ_MILLIS
+        sim.clock.set(int(t))
+        if not events.scan(mask, sim.clock.now):
+            continue
+        while (e := reader.read()) >= 0:
+            if events.pressed[e]:  # drum_on() here
+                latencies.append(t - touched[events.pads[e]])
+    return latencies
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    rand = random.Random(1234)
+    taps = make_taps(seconds, rand)
+    busy = merge_stalls(make_stalls('idle', seconds, rand))
+    print(f"{seconds} seconds, {len(taps)} taps, idle task load")
+    for name, sleep_millis, work_millis in (
+            (f"ui_handler every {UI_MILLIS} ms", UI_MILLIS, LED_WORK_MILLIS),
+            (f"touch_scanner every {SCAN_MILLIS} ms", SCAN_MILLIS, 0)):
+        latencies = run(taps, busy, seconds, sleep_millis, work_millis)
+        pcts = " ".join(f"p{p}={v:5.1f}" for p, v in sim.percentiles(latencies))
+        print(f"  {name:>26}: touch-to-trigger ms {pcts}  ({len(latencies)} triggers)")
+
+
+if __name__ == "__main__":
+    main()